@@ -74,6 +74,15 @@ class DatabaseBackend(object):
     def record_response(self, cursor, sender, recipient):
         raise exception.NotImplemented
 
+    def record_responses(self, cursor, records):
+        raise exception.NotImplemented
+
+    def get_enabled_configs(self, cursor):
+        raise exception.NotImplemented
+
+    def get_changed_configs(self, cursor, date):
+        raise exception.NotImplemented
+
     def get_pending_responses(self, cursor, limit):
         raise exception.NotImplemented
 
@@ -104,18 +113,22 @@ class MySQL(DatabaseBackend):
     import MySQLdb.cursors
     import _mysql_exceptions
     import sqlalchemy.pool as pool
+    import sqlalchemy.exc as pool_exceptions
 
     LABEL = 'MySQL'
 
     CURSOR_DEFAULT = MySQLdb.cursors.Cursor
     CURSOR_DICT = MySQLdb.cursors.DictCursor
 
-    # Connection pooling
-    DatabasePool = pool.manage(MySQLdb, recycle=120)
-
     def __init__(self, config):
         self.config = config
 
+        # Connection pooling: Never open more than pool_size connections,
+        # wait at most pool_timeout seconds for a free one.
+        self.DatabasePool = self.pool.manage(self.MySQLdb, recycle=120,
+                pool_size=self.config.pool_size, max_overflow=0,
+                timeout=self.config.pool_timeout)
+
         if self.config.socket.type == 'UNIX':
             self.name = self.config.socket.path
             self.connection_params = {
@@ -148,6 +161,11 @@ class MySQL(DatabaseBackend):
                     % self.name)
             raise exception.DatabaseError(
                     '%s: Could not connect to server: %s' % (self.LABEL, e))
+        except self.pool_exceptions.TimeoutError, e:
+            self._log(log.error, 'No free connection in pool (size %d)' \
+                    % self.config.pool_size)
+            raise exception.DatabaseError(
+                    '%s: Connection pool exhausted: %s' % (self.LABEL, e))
         self._log(log.debug, 'Successfully aquired connection from pool')
         return connection
 
@@ -230,6 +248,45 @@ class MySQL(DatabaseBackend):
                     % (sender, recipient, e))
             raise
 
+    def record_responses(self, cursor, records):
+        # One multi-row upsert: the records are passed to the query as a
+        # derived table with the columns sender, recipient and hit. Envelope
+        # senders may contain quotes, so each value is quoted and escaped by
+        # the connection: a single bad record must not break the batch.
+        literal = cursor.connection.literal
+        rows = ' UNION ALL '.join(
+                'SELECT %s AS `sender`, %s AS `recipient`, %s AS `hit`'
+                % tuple(literal(value) for value in record)
+                for record in records)
+        try:
+            result = self.query(cursor, self.config.query_record_responses, {
+                'rows': rows,
+            })
+            self._log(log.debug, 'Recorded %d autoresponses (%d rows affected)'
+                    % (len(records), result))
+            return result
+        except Exception, e:
+            self._log(log.info, 'Unable to record %d autoresponses - %s'
+                    % (len(records), e))
+            raise
+
+    def get_enabled_configs(self, cursor):
+        try:
+            self.query(cursor, self.config.query_enabled_configs)
+            return cursor.fetchall()
+        except Exception, e:
+            self._log(log.info, 'Unable to query for enabled configs: %s' % e)
+            raise
+
+    def get_changed_configs(self, cursor, date):
+        try:
+            self.query(cursor, self.config.query_changed_configs,
+                    {'date': date})
+            return cursor.fetchall()
+        except Exception, e:
+            self._log(log.info, 'Unable to query for changed configs: %s' % e)
+            raise
+
     def get_pending_responses(self, cursor, limit):
         try:
             return self.query(cursor, self.config.query_pending_responses,
@@ -286,7 +343,9 @@ class Manager(object):
     '''Backend Manager
 
     Each channel has one backend manager instance, resulting in:
-    - one backend connection (if possible from a pool) per channel
+    - one backend connection leased from a pool as soon as it is needed
+      for a message, and released right after all work for the message is
+      committed (see release)
     - thread safe query execution :-)
     '''
 
@@ -303,11 +362,25 @@ class Manager(object):
             self.connection = self.backend.connect(*args, **kwargs)
 
     def close(self):
-        if self.connection:
+        self.release()
+
+    def release(self, commit=True):
+        '''Commit (or roll back) and give the connection back to the
+        pool'''
+
+        if not self.connection:
+            return
+        try:
             if self.cursor:
                 self.backend.close_cursor(self.cursor)
-            self.backend.commit(self.connection)
-            self.backend.disconnect(self.connection)
+            if commit:
+                self.backend.commit(self.connection)
+            else:
+                self.backend.rollback(self.connection)
+        finally:
+            self.cursor = None
+            connection, self.connection = self.connection, None
+            self.backend.disconnect(connection)
 
     def get_cursor(self):
         if not self.cursor:
@@ -315,6 +388,9 @@ class Manager(object):
             self.cursor = self.backend.open_cursor(self.connection)
 
     def validate_recipient(self, *args, **kwargs):
+        # Don't lease a connection if there is nothing to query
+        if not self.backend.config.query_validate_recipient_enabled:
+            return
         self.connect()
         self.get_cursor()
         self.backend.validate_recipient(self.cursor, *args, **kwargs)
@@ -324,3 +400,18 @@ class Manager(object):
         self.get_cursor()
         self.backend.record_response(self.cursor, *args, **kwargs)
 
+    def record_responses(self, *args, **kwargs):
+        self.connect()
+        self.get_cursor()
+        return self.backend.record_responses(self.cursor, *args, **kwargs)
+
+    def enabled_configs(self, *args, **kwargs):
+        self.connect()
+        self.get_cursor()
+        return self.backend.get_enabled_configs(self.cursor, *args, **kwargs)
+
+    def changed_configs(self, *args, **kwargs):
+        self.connect()
+        self.get_cursor()
+        return self.backend.get_changed_configs(self.cursor, *args, **kwargs)
+
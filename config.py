@@ -40,6 +40,33 @@ class LMTPDConfig(object):
     hardfail = False
     softfail = True
     failsafe = False
+    workers = 0
+    timeout = 300
+    event_loop = 'poll'
+    backend_threads = 4
+    backend_queue_size = 64
+    early_validation = True
+    header_max_size = 65536
+    header_max_count = 500
+    header_max_line_length = 8192
+    header_overflow = 'skip'
+    verdict_cache_size = 10000
+    rules_file = ''
+    address_matching = 'combined'
+    validation_profile = False
+    record_batch_size = 0
+    record_batch_interval = 500
+    record_durability = 'before'
+    coalesce_window = 60
+    coalesce_size = 10000
+    duplicate_window = 300
+    duplicate_size = 10000
+    sender_rate = 0
+    sender_burst = 50
+    sender_limit_size = 10000
+    config_index = True
+    config_index_interval = 10
+    config_index_reload = 3600
 
     RECIPIENT_ADDRESS_REWRITE_RE = '(?P<user>\S+)#(?P<domain>\S+)@'
 
@@ -49,9 +76,14 @@ class BackendConfig(object):
     password = 'FIXME'
     database = 'response'
     adapter = backend.MySQL
+    pool_size = 5
+    pool_timeout = 10
     query_validate_recipient_enabled = False
     query_validate_recipient = ''
     query_record_response = ''
+    query_record_responses = ''
+    query_enabled_configs = ''
+    query_changed_configs = ''
     query_pending_responses = ''
     query_update_sent_timestamp = ''
     query_disable_expired_configs = ''
@@ -105,6 +137,63 @@ class Config(object):
         config.hardfail = config_file.getboolean(section, 'HARDFAIL')
         config.softfail = config_file.getboolean(section, 'SOFTFAIL')
         config.failsafe = config_file.getboolean(section, 'FAILSAFE')
+        config.workers = config_file.getint(section, 'WORKERS')
+        config.timeout = config_file.getint(section, 'TIMEOUT')
+        config.event_loop = config_file.get(section, 'EVENT_LOOP').lower()
+        if config.event_loop not in ('select', 'poll'):
+            raise exception.ConfigError(
+                    'invalid event loop: %s' % config.event_loop)
+        config.backend_threads = \
+                config_file.getint(section, 'BACKEND_THREADS')
+        config.backend_queue_size = \
+                config_file.getint(section, 'BACKEND_QUEUE_SIZE')
+        config.early_validation = \
+                config_file.getboolean(section, 'EARLY_VALIDATION')
+        config.header_max_size = \
+                config_file.getint(section, 'HEADER_MAX_SIZE')
+        config.header_max_count = \
+                config_file.getint(section, 'HEADER_MAX_COUNT')
+        config.header_max_line_length = \
+                config_file.getint(section, 'HEADER_MAX_LINE_LENGTH')
+        config.header_overflow = \
+                config_file.get(section, 'HEADER_OVERFLOW').lower()
+        if config.header_overflow not in ('skip', 'validate'):
+            raise exception.ConfigError(
+                    'invalid header overflow: %s' % config.header_overflow)
+        config.verdict_cache_size = \
+                config_file.getint(section, 'VERDICT_CACHE_SIZE')
+        config.rules_file = config_file.get(section, 'RULES_FILE').strip()
+        config.address_matching = \
+                config_file.get(section, 'ADDRESS_MATCHING').lower()
+        if config.address_matching not in ('linear', 'combined'):
+            raise exception.ConfigError(
+                    'invalid address matching: %s' % config.address_matching)
+        config.validation_profile = \
+                config_file.getboolean(section, 'VALIDATION_PROFILE')
+        config.record_batch_size = \
+                config_file.getint(section, 'RECORD_BATCH_SIZE')
+        config.record_batch_interval = \
+                config_file.getint(section, 'RECORD_BATCH_INTERVAL')
+        config.record_durability = \
+                config_file.get(section, 'RECORD_DURABILITY').lower()
+        if config.record_durability not in ('before', 'after'):
+            raise exception.ConfigError(
+                    'invalid record durability: %s' % config.record_durability)
+        config.coalesce_window = \
+                config_file.getint(section, 'COALESCE_WINDOW')
+        config.coalesce_size = config_file.getint(section, 'COALESCE_SIZE')
+        config.duplicate_window = \
+                config_file.getint(section, 'DUPLICATE_WINDOW')
+        config.duplicate_size = config_file.getint(section, 'DUPLICATE_SIZE')
+        config.sender_rate = config_file.getint(section, 'SENDER_RATE')
+        config.sender_burst = config_file.getint(section, 'SENDER_BURST')
+        config.sender_limit_size = \
+                config_file.getint(section, 'SENDER_LIMIT_SIZE')
+        config.config_index = config_file.getboolean(section, 'CONFIG_INDEX')
+        config.config_index_interval = \
+                config_file.getint(section, 'CONFIG_INDEX_INTERVAL')
+        config.config_index_reload = \
+                config_file.getint(section, 'CONFIG_INDEX_RELOAD')
         config.RECIPIENT_ADDRESS_REWRITE_RE = \
                 config_file.get(section, 'RECIPIENT_ADDRESS_REWRITE_RE')
 
@@ -121,6 +210,8 @@ class Config(object):
         config.password = config_file.get(section, 'PASSWORD')
         config.adapter = \
                 getattr(backend, config_file.get(section, 'ADAPTER'))
+        config.pool_size = config_file.getint(section, 'POOL_SIZE')
+        config.pool_timeout = config_file.getint(section, 'POOL_TIMEOUT')
         config.query_validate_recipient_enabled = \
                 config_file.getboolean(
                         section,
@@ -130,6 +221,9 @@ class Config(object):
         for query in [
                 'query_validate_recipient',
                 'query_record_response',
+                'query_record_responses',
+                'query_enabled_configs',
+                'query_changed_configs',
                 'query_pending_responses',
                 'query_update_sent_timestamp',
                 'query_disable_expired_configs',
@@ -77,6 +77,9 @@ class DatabaseError(Error):
 class DatabaseQueryError(Error):
     pass
 
+class QueueFullError(Error):
+    pass
+
 class ProcessError(Error):
     pass
 
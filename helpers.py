@@ -23,6 +23,7 @@
 from globals import __author__, __copyright__, __license__, __version__
 
 import os
+import threading
 import exception
 
 
@@ -52,3 +53,76 @@ def prepare_filepath(file, ignoreExisting=True):
             raise exception.FilePathError(2, 'Unable to write to dir %s' % d)
 
 
+class LRUCache(object):
+    '''Thread safe mapping of at most `size` items. The least recently
+    used item is dropped first.'''
+
+    # The items are kept in a dict of [prev, next, key, value] links, which
+    # form a circular doubly linked list in order of use: root[NEXT] is the
+    # least, root[PREV] the most recently used link.
+    PREV, NEXT, KEY, VALUE = 0, 1, 2, 3
+
+    def __init__(self, size):
+        self.size = size
+        self.lock = threading.Lock()
+        self.items = {}
+        self.root = []
+        self.root[:] = [self.root, self.root, None, None]
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.items)
+
+    def __contains__(self, key):
+        return key in self.items
+
+    def __unlink(self, link):
+        prev, next = link[self.PREV], link[self.NEXT]
+        prev[self.NEXT] = next
+        next[self.PREV] = prev
+
+    def __append(self, link):
+        last = self.root[self.PREV]
+        link[self.PREV], link[self.NEXT] = last, self.root
+        last[self.NEXT] = self.root[self.PREV] = link
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                link = self.items[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self.__unlink(link)
+            self.__append(link)
+            self.hits += 1
+            return link[self.VALUE]
+
+    def __setitem__(self, key, value):
+        with self.lock:
+            link = self.items.get(key)
+            if link is not None:
+                self.__unlink(link)
+                link[self.VALUE] = value
+            else:
+                link = [None, None, key, value]
+                self.items[key] = link
+            self.__append(link)
+            if len(self.items) > self.size:
+                oldest = self.root[self.NEXT]
+                self.__unlink(oldest)
+                del self.items[oldest[self.KEY]]
+
+    def pop(self, key, default=None):
+        with self.lock:
+            link = self.items.pop(key, None)
+            if link is None:
+                return default
+            self.__unlink(link)
+            return link[self.VALUE]
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+            self.root[:] = [self.root, self.root, None, None]
@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+
+'''Response Project - In-memory Index of Autoresponse Configs'''
+
+# Copyright (C) 2009-2010 John Feuerstein <john@feurix.com>
+#
+# This file is part of the response project.
+#
+# Response is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# Response is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Library General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+# ---
+#
+# The index is loaded completely once and then kept current by fetching
+# only the configs with a `changed` date newer than the latest change we
+# know of. Deleted configs never show up as changed, so the index is
+# reloaded completely every now and then.
+#
+# fetch() runs the blocking backend queries (in a backend thread) while
+# update() applies the result in the event loop thread. Lookups are safe
+# from any thread.
+
+from globals import __author__, __copyright__, __license__, __version__
+
+from datetime import datetime, timedelta
+from backend import Manager
+
+from logger import getModuleLog
+log = getModuleLog(__name__)
+
+
+# Fetch changes this much older than the latest change we know of again,
+# they may have been committed late.
+OVERLAP = timedelta(seconds=60)
+
+EPOCH = datetime(1970, 1, 1)
+
+class ConfigIndex(object):
+    '''Map the addresses of all enabled autoresponse configs to their ids'''
+
+    def __init__(self, backend, reload):
+        self.manager = Manager(backend)
+        self.reload = reload
+        self.configs = None
+        self.changed = None
+        self.loaded = 0
+
+    @property
+    def ready(self):
+        return self.configs is not None
+
+    def __len__(self):
+        return len(self.configs or ())
+
+    def __contains__(self, address):
+        # Addresses are compared case insensitive by the database, too
+        return address.lower() in self.configs
+
+    def get(self, address, default=None):
+        return self.configs.get(address.lower(), default)
+
+    def fetch(self, now):
+        '''Query the backend for all enabled configs if a complete reload
+        is due, for the changed configs otherwise.
+
+        Return: (complete, rows of id, address, enabled, changed)'''
+
+        complete = not self.ready or now - self.loaded >= self.reload
+        try:
+            if complete:
+                rows = self.manager.enabled_configs()
+            else:
+                rows = self.manager.changed_configs(
+                        (self.changed or EPOCH) - OVERLAP)
+        finally:
+            self.manager.release()
+        return complete, rows
+
+    def update(self, now, complete, rows):
+        if complete:
+            configs = {}
+            self.loaded = now
+        else:
+            configs = self.configs
+
+        for id, address, enabled, changed in rows:
+            if enabled:
+                configs[address.lower()] = id
+            else:
+                configs.pop(address.lower(), None)
+            if changed is not None \
+                    and (self.changed is None or changed > self.changed):
+                self.changed = changed
+
+        self.configs = configs
+        log.debug('%s config index: %d rows, %d enabled configs'
+                % (complete and 'Loaded' or 'Updated', len(rows), len(configs)))
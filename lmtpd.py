@@ -26,17 +26,25 @@ import os
 import re
 import sys
 import socket
+import errno
 import asyncore
 import asynchat
 import time
 import select
+import signal
 import exception
 
+from functools import partial
 from smtpd import SMTPServer
 from mail import Message, Parser
 from backend import Manager
-from validate import validate
-from record import record
+from validate import validate, valid_sender_address, valid_recipient_address
+from validate import load_rules, rule_files, rule_stats, verdict_cache_stats
+from rules import Profile
+from record import record, record_batch, RecordBuffer, RecentHits, \
+        RecentDeliveries, SenderLimits
+from workers import WorkerPool
+from index import ConfigIndex
 
 from logger import getModuleLog
 log = getModuleLog(__name__)
@@ -47,11 +55,31 @@ class LMTPChannel(asynchat.async_chat):
     # State
     COMMAND = 0
     DATA = 1
+    CHUNK = 2
+
+    # LHLO keywords (RFC 2920, RFC 2034, RFC 3030)
+    EXTENSIONS = [
+        'PIPELINING',
+        'ENHANCEDSTATUSCODES',
+        'CHUNKING',
+    ]
 
     # RFC 2822
     COMMAND_TERMINATOR = '\r\n'
     DATA_TERMINATOR = '\r\n.\r\n'
 
+    # RFC 2821 allows 512 octets per command line, be a bit more tolerant
+    # but never buffer an endless line.
+    COMMAND_MAX_LENGTH = 4096
+
+    # Flow control: Stop reading new commands as long as the client does
+    # not read our replies.
+    MAX_PENDING_REPLIES = 64
+
+    # Receive buffer used to discard the message body once we have all
+    # headers. Shared by all channels of the (single threaded) event loop.
+    SKIP_BUFFER = bytearray(65536)
+
     def __init__(self, server, conn, addr):
         log.debug('>>> OPEN <LMTPChannel at %#x>' % id(self))
         asynchat.async_chat.__init__(self, conn)
@@ -61,49 +89,231 @@ class LMTPChannel(asynchat.async_chat):
         self.__greeting = 0
         self.__fqdn = socket.getfqdn()
         self.__peer = conn.getpeername()
+        self.__last_activity = time.time()
+        self.__busy = False
+        self.__unrecorded = 0
+        self.__processing = False
+        self.__replies = []
+        self.__delivering = (None, None)
 
-        try:
-            self.__backend_manager = Manager(server.backend)
-            self.__backend_manager.connect()
-        except exception.DatabaseError, e:
-            # We handle this later (smtp_RCPT) where the protocol
-            # allows us to send the necessary status code.
-            log.error('Backend failure while initializing channel: %s' % e)
-        except Exception, e:
-            log.error('Unhandled backend failure while initializing ' \
-                      'channel: %s' % e)
+        # We batch our replies on our own (see flush)
+        if conn.family == socket.AF_INET:
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        # The backend connection is leased from the pool per message only
+        # (see __deliver), idle channels don't hold one.
+        self.__backend_manager = Manager(server.backend)
 
         self.reset()
         self.push('220 %s %s' % (self.__fqdn, __version__))
+        self.flush()
 
     def reset(self):
         # Make us ready for the next message
         self.__mailfrom = None
-        self.__rcptto = None
+        self.__rcptto = []
         self.__command = []
-        self.__parser = Parser(Message)
+        self.__mailvalid = True
+        self.__rcptvalid = []
+        self.__doomed = False
+        self.__chunking = False
+        self.__chunk_error = None
+        self.__last_chunk = False
+        self.__command_length = 0
+        config = self.__server.config
+        self.__parser = Parser(Message, config.header_max_size,
+                config.header_max_count, config.header_max_line_length)
 
         self.__state = self.COMMAND
         self.set_terminator(self.COMMAND_TERMINATOR)
 
     def push(self, msg):
-        asynchat.async_chat.push(self, msg + self.COMMAND_TERMINATOR)
+        # Replies are collected and sent in one go by flush(), as soon as
+        # we processed all (pipelined) commands we have received so far.
+        self.__replies.append(msg)
+
+    def flush(self):
+        if self.__replies:
+            self.__replies.append('')
+            asynchat.async_chat.push(self,
+                    self.COMMAND_TERMINATOR.join(self.__replies))
+            self.__replies = []
+
+    def readable(self):
+        # Don't read ahead while we wait for the backend (see __deliver)
+        return not self.__busy \
+                and len(self.producer_fifo) < self.MAX_PENDING_REPLIES \
+                and asynchat.async_chat.readable(self)
+
+    def handle_read(self):
+        self.__last_activity = time.time()
+        if self.__state in (self.DATA, self.CHUNK) \
+                and (self.__doomed or self.__parser.headers_complete):
+            self.__skip_body()
+            return
+        try:
+            data = self.recv(self.ac_in_buffer_size)
+        except socket.error, why:
+            if why.args[0] in (errno.EWOULDBLOCK, errno.EAGAIN):
+                return
+            self.handle_error()
+            return
+        self.ac_in_buffer = self.ac_in_buffer + data
+        self.__process_input()
+
+    def __process_input(self):
+        # Backend results may be delivered while we process input (without
+        # worker threads), the outer loop will continue on its own then.
+        if self.__processing:
+            return
+        self.__processing = True
+        try:
+            self.__process_buffer()
+        finally:
+            self.__processing = False
+        # Replies to pipelined commands are held back until we are done
+        # with the message, so they all fit into one write.
+        if not self.__busy:
+            self.flush()
+
+    def __process_buffer(self):
+        # Same as asynchat.async_chat.handle_read, but processing of
+        # buffered input (pipelined commands) stops as long as we are busy
+        # and may be resumed later without reading from the socket.
+        while self.ac_in_buffer and not self.__busy:
+            terminator = self.get_terminator()
+            if isinstance(terminator, (int, long)):
+                # BDAT chunk
+                if len(self.ac_in_buffer) < terminator:
+                    self.collect_incoming_data(self.ac_in_buffer)
+                    self.terminator -= len(self.ac_in_buffer)
+                    self.ac_in_buffer = ''
+                else:
+                    self.collect_incoming_data(
+                            self.ac_in_buffer[:terminator])
+                    self.ac_in_buffer = self.ac_in_buffer[terminator:]
+                    self.terminator = 0
+                    self.found_terminator()
+                continue
+            index = self.ac_in_buffer.find(terminator)
+            if index != -1:
+                if index > 0:
+                    self.collect_incoming_data(self.ac_in_buffer[:index])
+                self.ac_in_buffer = \
+                        self.ac_in_buffer[index+len(terminator):]
+                self.found_terminator()
+            else:
+                index = asynchat.find_prefix_at_end(self.ac_in_buffer,
+                        terminator)
+                if index:
+                    if index != len(self.ac_in_buffer):
+                        self.collect_incoming_data(
+                                self.ac_in_buffer[:-index])
+                        self.ac_in_buffer = self.ac_in_buffer[-index:]
+                    break
+                else:
+                    self.collect_incoming_data(self.ac_in_buffer)
+                    self.ac_in_buffer = ''
+
+    def __skip_body(self):
+        # We are only interested in message headers: Receive the rest of
+        # the message into a reusable buffer and only look for the end of
+        # data. Nothing is buffered or handed to the parser. As in
+        # asynchat, self.ac_in_buffer keeps a partial terminator seen at
+        # the end of the previous chunk.
+        buffer = self.SKIP_BUFFER
+        try:
+            size = self.socket.recv_into(buffer)
+        except socket.error, why:
+            if why.args[0] in (errno.EWOULDBLOCK, errno.EAGAIN):
+                return
+            elif why.args[0] in asyncore._DISCONNECTED:
+                self.handle_close()
+                return
+            self.handle_error()
+            return
+        if not size:
+            self.handle_close()
+            return
+
+        # BDAT chunk: Just count the octets (RFC 3030)
+        if self.__state == self.CHUNK:
+            if size < self.terminator:
+                self.terminator -= size
+                return
+            self.ac_in_buffer = str(buffer[self.terminator:size])
+            self.terminator = 0
+            self.found_terminator()
+            self.__process_input()
+            return
+
+        terminator = self.DATA_TERMINATOR
+        tail = self.ac_in_buffer
+        end = -1
+
+        # Terminator spanning the previous and this chunk?
+        if tail:
+            window = tail + str(buffer[:min(size, len(terminator) - 1)])
+            index = window.find(terminator)
+            if index != -1:
+                end = index + len(terminator) - len(tail)
+
+        # Terminator within this chunk?
+        if end == -1:
+            index = buffer.find(terminator, 0, size)
+            if index != -1:
+                end = index + len(terminator)
+
+        if end == -1:
+            start = max(0, size - len(terminator) + 1)
+            window = tail + str(buffer[start:size])
+            index = asynchat.find_prefix_at_end(window, terminator)
+            if index:
+                self.ac_in_buffer = window[-index:]
+            else:
+                self.ac_in_buffer = ''
+            return
+
+        # End of data, continue with pipelined commands
+        self.ac_in_buffer = str(buffer[end:size])
+        self.found_terminator()
+        self.__process_input()
+
+    def idle(self, now):
+        if self.__busy:
+            return 0
+        return now - self.__last_activity
+
+    def timeout(self):
+        log.info('Timeout of <LMTPChannel at %#x> (peer %s)'
+                % (id(self), self.__peer[0]))
+        self.push('421 4.4.2 %s Error: timeout exceeded' % self.__fqdn)
+        self.flush()
+        self.close_when_done()
 
     def collect_incoming_data(self, data):
         if self.__state == self.COMMAND:
-            self.__command.append(data)
-        elif self.__state == self.DATA:
+            # Discard the rest of an overlong line, the error is reported
+            # as soon as we see the end of it.
+            self.__command_length += len(data)
+            if self.__command_length <= self.COMMAND_MAX_LENGTH:
+                self.__command.append(data)
+        elif self.__state in (self.DATA, self.CHUNK) and not self.__doomed:
             self.__parser.feed(data)
 
     def handle_close(self):
         log.debug('<<< CLOSE <LMTPChannel at %#x>' % id(self))
-        self.__backend_manager.close()
         self.close()
 
     def found_terminator(self):
         line = ''.join(self.__command)
+        length = self.__command_length
         self.__command = []
+        self.__command_length = 0
         if self.__state == self.COMMAND:
+            if length > self.COMMAND_MAX_LENGTH:
+                self.push('500 5.5.2 Error: line too long')
+                return
             if not line:
                 self.push('500 5.5.1 Error: bad syntax')
                 return
@@ -122,32 +332,93 @@ class LMTPChannel(asynchat.async_chat):
             method(arg)
             return
         else:
-            if self.__state != self.DATA:
-                self.push('451 5.5.1 Internal server error')
+            if self.__state not in (self.DATA, self.CHUNK):
+                self.push('451 4.3.0 Internal server error')
+                return
+
+            if self.__state == self.CHUNK \
+                    and (self.__chunk_error or not self.__last_chunk):
+                if self.__chunk_error:
+                    self.push(self.__chunk_error)
+                    self.__chunk_error = None
+                else:
+                    self.push('250 2.0.0 %d octets received'
+                            % self.__chunk_size)
+                self.__state = self.COMMAND
+                self.set_terminator(self.COMMAND_TERMINATOR)
+                return
+
+            recipients = zip(self.__rcptto, self.__rcptvalid)
+
+            # All recipients failed envelope validation: Nothing to parse,
+            # validate or record.
+            if self.__doomed:
+                self.reset()
+                self.__delivered(([self.__failure_reply()]
+                        * len(recipients), [], set()))
                 return
 
-            # Message complete
+            # Message complete, headers are parsed only once for all
+            # recipients of this transaction.
             message = self.__parser.close()
             message.set_unixfrom(self.__mailfrom)
-            message.set_unixto(self.__rcptto)
-
-            # Notify the MTA of an error only if configured to do so
-            if self.__backend_manager:
-                try:
-                    self.__server.process_message(
-                        self.__backend_manager,
-                        message,
-                        )
-                except exception.ProcessError, e:
-                    # Note: A softfail doesn't make sense here.
-                    if not self.__server.config.failsafe:
-                        if self.__server.config.hardfail:
-                            self.push('552 5.5.1 Error processing message')
-                            return
-
-            # Ready for the next message
+
+            # Oversized header block: The rest was discarded unparsed
+            if self.__parser.overflow is not None:
+                log.info('Message from %s exceeds the header limits: %s'
+                        % (self.__mailfrom, self.__parser.overflow))
+                if self.__server.config.header_overflow == 'skip':
+                    self.reset()
+                    self.__delivered(([self.__failure_reply()]
+                            * len(recipients), [], set()))
+                    return
+
+            # Copies of a message that was already processed for a
+            # recipient (alias expansion, retries) are acknowledged right
+            # away, the processed ones remembered with their final reply.
+            now = time.time()
+            deliveries = self.__server.deliveries
+            message_id = message.get('Message-ID', '').strip()
+            if deliveries is None or not message_id:
+                message_id = None
+            skips = []
+            for recipient, valid in recipients:
+                skip = False
+                if not valid:
+                    pass
+                elif message_id is not None \
+                        and deliveries.seen(message_id, recipient, now):
+                    log.info('Duplicate delivery of %s to %s'
+                            % (message_id, recipient))
+                    skip = True
+                skips.append(skip)
+            recipients = [(recipient, valid, skip) for (recipient, valid),
+                    skip in zip(recipients, skips)]
+
+            # Ready for the next message, which we won't read before the
+            # replies for this one were sent.
             self.reset()
-            self.push('250 Ok')
+            self.__delivering = (message_id, recipients)
+
+            # Nothing left to validate or record
+            if not [recipient for recipient, valid, skip in recipients
+                    if valid and not skip]:
+                self.__delivered(([skip and '250 2.0.0 Ok'
+                        or self.__failure_reply()
+                        for recipient, valid, skip in recipients], [], set()))
+                return
+
+            self.__busy = True
+            try:
+                self.__server.submit(self.__deliver, (message, recipients),
+                        self.__delivered)
+            except exception.QueueFullError, e:
+                log.warning('Unable to process message: %s' % e)
+                if self.__server.config.failsafe:
+                    reply = '250 2.0.0 Ok'
+                else:
+                    reply = '451 4.3.2 System busy, try again later'
+                self.__delivered(([reply] * len(recipients), [], set()))
 
     #
     # Internal helpers
@@ -164,12 +435,132 @@ class LMTPChannel(asynchat.async_chat):
                 address = address[1:-1]
         return address
 
+    def __deliver(self, message, recipients):
+        # Runs in a backend worker thread if configured, never touch the
+        # channel state here!
+        #
+        # RFC 2033: After the final ".", the server returns one reply
+        # for each recipient that was successfully named in a RCPT
+        # command, in the order that the RCPT commands were issued.
+        #
+        # Returns the replies, the (reply index, batch) pairs of the
+        # records that are buffered for writing (see RecordBuffer) and the
+        # reply indexes of the recipients the message was processed for.
+        replies = []
+        batches = []
+        processed = set()
+        failure = None
+        try:
+            for recipient, valid, skip in recipients:
+                if skip:
+                    replies.append('250 2.0.0 Ok')
+                elif not valid:
+                    replies.append(self.__failure_reply())
+                elif failure:
+                    # Don't hammer an unavailable backend
+                    replies.append(failure)
+                else:
+                    message.set_unixto(recipient)
+                    try:
+                        reply, batch = self.__process(message)
+                        if batch:
+                            batches.append((len(replies), batch))
+                        processed.add(len(replies))
+                        replies.append(reply)
+                    except exception.DatabaseError, e:
+                        log.error('Backend failure: %s' % e)
+                        failure = self.__backend_failure_reply()
+                        replies.append(failure)
+        finally:
+            # Give the connection back to the pool as soon as possible
+            try:
+                self.__backend_manager.release(commit=not failure)
+            except Exception, e:
+                log.error('Backend failure while releasing connection: %s'
+                        % e)
+        return replies, batches, processed
+
+    def __delivered(self, result):
+        self.__busy = False
+        if not self.connected:
+            return
+        if result is None:
+            # The job raised: Still one reply per recipient (RFC 2033)
+            message_id, recipients = self.__delivering
+            result = (['451 4.3.0 Internal server error'] * len(recipients),
+                    [], set())
+        replies, batches, processed = result
+        if batches and self.__server.config.record_durability == 'before':
+            # Hold back the replies until the records are written
+            self.__busy = True
+            self.__unrecorded = len(batches)
+            for index, batch in batches:
+                batch.notify(partial(self.__recorded, replies, processed,
+                        index))
+            return
+        self.__reply(replies, processed)
+
+    def __recorded(self, replies, processed, index, success):
+        if not success:
+            replies[index] = self.__backend_failure_reply()
+            processed.discard(index)
+        self.__unrecorded -= 1
+        if self.__unrecorded > 0:
+            return
+        self.__busy = False
+        if self.connected:
+            self.__reply(replies, processed)
+
+    def __reply(self, replies, processed):
+        # Remember the recipients the message was validated and recorded
+        # for, unless the MTA will try again (see DUPLICATE_WINDOW). Not
+        # the ones answered without (a busy or failed backend with
+        # FAILSAFE), a retry must not be dropped as a duplicate.
+        message_id, recipients = self.__delivering
+        self.__delivering = (None, None)
+        if message_id is not None:
+            now = time.time()
+            for index in processed:
+                if replies[index][0] != '4':
+                    self.__server.deliveries.add(message_id,
+                            recipients[index][0], now)
+        for reply in replies:
+            self.push(reply)
+        # Continue with pipelined input we didn't process while busy
+        self.__process_input()
+
+    def __process(self, message):
+        try:
+            batch = self.__server.process_message(
+                self.__backend_manager,
+                message,
+                )
+        except exception.ProcessError, e:
+            return self.__failure_reply(), None
+        return '250 2.0.0 Ok', batch
+
+    def __failure_reply(self):
+        # Notify the MTA of an error only if configured to do so
+        # Note: A softfail doesn't make sense here.
+        if not self.__server.config.failsafe:
+            if self.__server.config.hardfail:
+                return '552 5.5.1 Error processing message'
+        return '250 2.0.0 Ok'
+
+    def __backend_failure_reply(self):
+        # Bail out if configured to do so...
+        if not self.__server.config.failsafe:
+            if self.__server.config.hardfail:
+                return '550 5.3.0 Backend failure'
+            return '451 4.3.0 Backend failure, try again later'
+        return '250 2.0.0 Ok'
+
     def __parse_recipient(self, address):
         match = re.match(self.__server.config.RECIPIENT_ADDRESS_REWRITE_RE,
                 address)
 
         if not match:
-            self.push('501 5.5.2 Unknown recipient address format: %s'
+            self.push('501 5.1.3 Unknown recipient address format: %s'
                     % address)
             return
 
@@ -192,13 +583,17 @@ class LMTPChannel(asynchat.async_chat):
             self.push('503 5.5.1 Duplicate LHLO')
         else:
             self.__greeting = arg
-            self.push('250 %s' % self.__fqdn)
+            self.push('250-%s' % self.__fqdn)
+            for extension in self.EXTENSIONS[:-1]:
+                self.push('250-%s' % extension)
+            self.push('250 %s' % self.EXTENSIONS[-1])
 
     def smtp_NOOP(self, arg):
         self.push('250 2.0.0 Ok')
 
     def smtp_QUIT(self, arg):
         self.push('221 2.0.0 Bye')
+        self.flush()
         self.close_when_done()
 
     def smtp_MAIL(self, arg):
@@ -210,44 +605,53 @@ class LMTPChannel(asynchat.async_chat):
             self.push('503 5.5.1 Error: nested MAIL command')
             return
         self.__mailfrom = address
+
+        # The sender may be invalid for all recipients already. Accept the
+        # message anyway, but don't care about it any further.
+        if self.__server.config.early_validation:
+            self.__mailvalid = valid_sender_address(address)
+            if not self.__mailvalid:
+                log.info('Envelope validation (%s) failed: Invalid sender'
+                        % address)
+
         self.push('250 2.1.0 Sender Ok')
 
     def smtp_RCPT(self, arg):
-        if self.__rcptto:
-            #
-            # Note: We don't support mulpitle recipients per message!
-            # You may send multiple messages per recipient, though.
-            #
-            # Hint for Postfix: response_destination_recipient_limit = 1
-            #
-            #   Setting this parameter to a value of 1 changes the meaning
-            #   of the corresponding per-destination concurrency limit from
-            #   concurrency per domain into concurrency per recipient.
-            #
-            self.push('503 5.5.1 Duplicate RCPT TO')
-            return
         if not self.__mailfrom:
             self.push('503 5.5.1 Error: need MAIL command')
             return
+        if self.__chunking:
+            self.push('503 5.5.1 Error: BDAT in progress')
+            return
 
         # Normalize recipient address
         address = self.__getaddr('TO:', arg)
+        if not address:
+            self.push('501 5.5.4 Syntax: RCPT TO:<address>')
+            return
         address = self.__parse_recipient(address)
 
         if not address:
             return
 
-        # Bail out if configured to do so...
-        if not self.__backend_manager and not self.__server.config.failsafe:
-            if self.__server.config.hardfail:
-                self.push('550 5.5.1 Backend failure')
-                return
-            else:
-                self.push('451 4.3.1 Backend failure, try again later')
-                return
-
-        self.__rcptto = address
-        self.push('250 2.1.0 Recipient OK')
+        valid = self.__mailvalid
+        if valid and self.__server.config.early_validation:
+            valid = address != self.__mailfrom \
+                    and valid_recipient_address(address)
+            if not valid:
+                log.info('Envelope validation (%s -> %s) failed: '
+                        'Invalid recipient' % (self.__mailfrom, address))
+            elif not self.__server.known_recipient(address):
+                valid = False
+                log.info('Envelope validation (%s -> %s) failed: '
+                        'No enabled autoresponse config'
+                        % (self.__mailfrom, address))
+
+        # Multiple recipients per transaction are fine (RFC 2033), each
+        # one gets its own reply after the end of the message data.
+        self.__rcptto.append(address)
+        self.__rcptvalid.append(valid)
+        self.push('250 2.1.5 Recipient Ok')
 
     def smtp_RSET(self, arg):
         self.reset()
@@ -255,18 +659,47 @@ class LMTPChannel(asynchat.async_chat):
 
     def smtp_DATA(self, arg):
         if not self.__rcptto:
-            self.push('503 5.0.1 Error: need RCPT command')
+            self.push('503 5.5.1 Error: need RCPT command')
+            return
+        if self.__chunking:
+            self.push('503 5.5.1 Error: BDAT in progress')
             return
         if arg:
-            self.push('501 5.0.2 Syntax: DATA')
+            self.push('501 5.5.4 Syntax: DATA')
             return
+        self.__doomed = not True in self.__rcptvalid
         self.__state = self.DATA
         self.set_terminator(self.DATA_TERMINATOR)
         self.push('354 End data with <CR><LF>.<CR><LF>')
 
+    def smtp_BDAT(self, arg):
+        # RFC 3030: The chunk data follows the command immediately, there
+        # is no intermediate reply.
+        args = (arg or '').split()
+        if not 0 < len(args) < 3 or not args[0].isdigit() \
+                or (len(args) == 2 and args[1].upper() != 'LAST'):
+            self.push('501 5.5.4 Syntax: BDAT chunk-size [LAST]')
+            return
+        if not self.__rcptto:
+            # The chunk is discarded (doomed), answer afterwards
+            self.__chunk_error = '503 5.5.1 Error: need RCPT command'
+        elif not self.__chunking:
+            self.__chunking = True
+        self.__doomed = not True in self.__rcptvalid
+        self.__chunk_size = int(args[0])
+        self.__last_chunk = len(args) == 2
+        self.__state = self.CHUNK
+        self.set_terminator(self.__chunk_size)
+        if not self.__chunk_size:
+            self.found_terminator()
+
 
 class LMTPServer(SMTPServer):
 
+    # Maximum time (seconds) to block in a single event loop iteration, and
+    # interval of periodic housekeeping (channel timeouts, ...).
+    LOOP_TIMEOUT = 1.0
+
     @property
     def _socket(self):
         return self.config.socket
@@ -280,6 +713,54 @@ class LMTPServer(SMTPServer):
 
         self.config = config.lmtpd
         self.backend = config.backend.adapter(config.backend)
+        self.workers = None
+
+        # Validation rules, reloaded by tick() when the rules file changes.
+        # Also drops the verdicts of the previous configuration.
+        self.profile = None
+        if self.config.validation_profile:
+            self.profile = Profile()
+        self.__load_rules()
+        self.__rules_mtime = self.__stat_rules()
+        self.__stats_requested = False
+
+        # Write-behind recording of responses
+        self.records = None
+        if self.config.record_batch_size > 0:
+            self.records = RecordBuffer(self.config.record_batch_size,
+                    self.config.record_batch_interval / 1000.0)
+        self.__record_manager = Manager(self.backend)
+        self.__flushing = False
+
+        # Only a process that served connections has stats worth logging
+        # (not the supervising parent of the prefork workers)
+        self.serving = False
+
+        # Skip repeated records of the same pair
+        self.recent = None
+        if self.config.coalesce_window > 0:
+            self.recent = RecentHits(self.config.coalesce_size,
+                    self.config.coalesce_window)
+
+        # Skip repeated deliveries of the same message
+        self.deliveries = None
+        if self.config.duplicate_window > 0:
+            self.deliveries = RecentDeliveries(self.config.duplicate_size,
+                    self.config.duplicate_window)
+
+        # Don't record storms of hits of a single sender
+        self.senders = None
+        if self.config.sender_rate > 0:
+            self.senders = SenderLimits(self.config.sender_rate / 60.0,
+                    self.config.sender_burst, self.config.sender_limit_size)
+
+        # Local copy of the enabled autoresponse configs
+        self.index = None
+        if self.config.config_index:
+            self.index = ConfigIndex(self.backend,
+                    self.config.config_index_reload)
+        self.__syncing = False
+        self.__last_sync = 0
 
         if self._socket.type == 'TCP':
             self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -293,21 +774,217 @@ class LMTPServer(SMTPServer):
             raise exception.ConfigError(
                     'invalid socket: %s' % self.socket)
 
-        self.listen(5)
+        self.listen(socket.SOMAXCONN)
+        self.__last_tick = time.time()
         log.info('Listening for network connections')
 
+    def serve(self):
+        '''Run the event loop until all sockets are closed or a signal is
+        received, doing periodic housekeeping in between.'''
+
+        use_poll = self.config.event_loop == 'poll'
+        log.debug('Using %s() event loop' % self.config.event_loop)
+        self.serving = True
+
+        # Threads don't survive a fork, start them in the serving process
+        if self.config.backend_threads > 0:
+            self.workers = WorkerPool(self.config.backend_threads,
+                    self.config.backend_queue_size)
+
+        if self.index is not None:
+            self.sync_index(time.time())
+
+        # Log the validation stats with the next tick
+        signal.signal(signal.SIGUSR1, self.__request_stats)
+
+        timeout = self.LOOP_TIMEOUT
+        if self.records is not None:
+            timeout = min(timeout, self.records.interval)
+
+        while asyncore.socket_map:
+            asyncore.loop(timeout=timeout, use_poll=use_poll, count=1)
+            now = time.time()
+            if self.records is not None and not self.__flushing \
+                    and self.records.due(now):
+                self.flush_records()
+            if now - self.__last_tick >= self.LOOP_TIMEOUT:
+                self.__last_tick = now
+                self.tick(now)
+
+    def tick(self, now):
+        # Close idle channels
+        for channel in asyncore.socket_map.values():
+            if isinstance(channel, LMTPChannel) \
+                    and channel.idle(now) > self.config.timeout:
+                channel.timeout()
+
+        if self.index is not None and not self.__syncing \
+                and now - self.__last_sync >= self.config.config_index_interval:
+            self.sync_index(now)
+
+        if self.config.rules_file and self.__stat_rules() != self.__rules_mtime:
+            self.reload_rules()
+
+        if self.__stats_requested:
+            self.__stats_requested = False
+            self.log_stats()
+
+    def __request_stats(self, signum, frame):
+        self.__stats_requested = True
+
+    def __stat_rules(self):
+        # The rules file and the domain lists it refers to
+        mtimes = []
+        for filename in rule_files():
+            try:
+                mtimes.append(os.stat(filename).st_mtime)
+            except OSError:
+                mtimes.append(None)
+        return mtimes
+
+    def __load_rules(self):
+        return load_rules(self.config.rules_file,
+                self.config.verdict_cache_size, self.profile,
+                self.config.address_matching == 'linear')
+
+    def reload_rules(self):
+        '''Replace the validation rules with the rules of the rules file.
+        The rules in use are kept if the file is invalid.'''
+
+        try:
+            previous = self.__load_rules()
+        except exception.ConfigError, e:
+            log.error('Unable to reload validation rules: %s' % e)
+            return
+        finally:
+            self.__rules_mtime = self.__stat_rules()
+        self.log_rule_stats(previous.stats())
+
+    def log_rule_stats(self, stats):
+        for kind, group, pattern, hits in stats:
+            if hits:
+                log.info('Rule hits (%s, %s): %d: %s'
+                        % (kind, group, hits, pattern))
+
+    def log_stats(self):
+        '''Log the verdict cache stats, the rule hits and, if enabled, the
+        validation profile'''
+
+        for name, size, hits, misses in verdict_cache_stats():
+            log.info('Verdict cache (%s): %d addresses, %d hits, '
+                    '%d misses' % (name, size, hits, misses))
+        self.log_rule_stats(rule_stats())
+        if self.profile is None:
+            return
+        log.info('Validation profile of the last %d seconds (most time '
+                'consuming first):' % (time.time() - self.profile.started))
+        for (kind, group, pattern), calls, elapsed, matches \
+                in self.profile.report():
+            if pattern is None:
+                log.info('Stage %s: %d calls, %.3f ms, %.1f us/call, '
+                        '%d failed' % (group, calls, elapsed * 1e3,
+                                       elapsed / calls * 1e6, matches))
+            else:
+                log.info('Rule (%s, %s): %d calls, %.3f ms, %.1f us/call, '
+                        '%d matches: %s' % (kind, group, calls, elapsed * 1e3,
+                                            elapsed / calls * 1e6, matches,
+                                            pattern))
+
+    def submit(self, function, args, callback):
+        '''Run function(*args), a blocking backend operation, and pass
+        the result to callback() in the event loop thread. Without
+        backend worker threads this happens before submit() returns.'''
+
+        if self.workers:
+            self.workers.submit(function, args, callback)
+        else:
+            callback(function(*args))
+
+    def flush_records(self):
+        '''Write the buffered response records (in a backend thread)'''
+
+        self.__flushing = True
+        try:
+            self.submit(self.__write_records, (), self.__records_written)
+        except exception.QueueFullError, e:
+            # Try again with the next event loop iteration
+            log.debug('Unable to flush response records: %s' % e)
+            self.__flushing = False
+
+    def __write_records(self):
+        batch = self.records.take()
+        if not batch:
+            return batch, True
+        try:
+            record_batch(self.__record_manager, batch.records)
+        except Exception, e:
+            log.error('Unable to write %d response records: %s'
+                    % (len(batch), e))
+            return batch, False
+        return batch, True
+
+    def __records_written(self, result):
+        self.__flushing = False
+        batch, success = result
+        if not success and self.recent is not None:
+            for sender, recipient in batch.hits:
+                self.recent.forget(sender, recipient)
+        batch.finish(success)
+
+    def sync_index(self, now):
+        '''Update the config index (in a backend thread)'''
+
+        self.__syncing = True
+        self.__last_sync = now
+        try:
+            self.submit(self.__fetch_index, (now,), self.__index_fetched)
+        except exception.QueueFullError, e:
+            log.debug('Unable to update config index: %s' % e)
+            self.__syncing = False
+
+    def __fetch_index(self, now):
+        try:
+            return now, self.index.fetch(now)
+        except Exception, e:
+            log.error('Unable to update config index: %s' % e)
+
+    def __index_fetched(self, result):
+        self.__syncing = False
+        if result is not None:
+            now, (complete, rows) = result
+            self.index.update(now, complete, rows)
+
+    def known_recipient(self, address):
+        '''Return False only if the config index knows that there is no
+        enabled autoresponse config for address'''
+
+        if self.index is None or not self.index.ready:
+            return True
+        return address in self.index
+
     def process_message(self, manager, message):
+        '''Validate and record a message. Returns the batch the record
+        will be written with if recording is buffered.'''
+
         log.debug('Processing message: %s -> %s' \
                 % (message.get_unixfrom(), message.get_unixto()))
         try:
-            validate(manager=manager, message=message)
-            record(manager=manager, message=message)
+            validate(manager=manager, message=message, index=self.index)
+            return record(manager=manager, message=message,
+                    buffer=self.records, recent=self.recent,
+                    limits=self.senders)
         except exception.ProcessError, e:
             log.debug('Error processing message')
             raise
 
     def shutdown(self):
         try:
+            if self.workers:
+                self.workers.close()
+            if self.records is not None:
+                self.__records_written(self.__write_records())
+            if self.serving:
+                self.log_stats()
             self._socket.close()
             self.backend.close()
         except:
@@ -315,7 +992,11 @@ class LMTPServer(SMTPServer):
         log.warning('Shutting down.')
 
     def handle_accept(self):
-        conn, addr = self.accept()
+        # Another worker process may have been faster (see prefork.py)
+        pair = self.accept()
+        if pair is None:
+            return
+        conn, addr = pair
         if not addr[0] in self._socket_acl:
             log.warning('Unknown connection from %s denied.' % addr[0])
             return
@@ -22,8 +22,10 @@
 
 from globals import __author__, __copyright__, __license__, __version__
 
-import email.message
-import email.feedparser
+import re
+
+from email.header import decode_header
+from email.errors import HeaderParseError
 
 
 # RFC 2822
@@ -31,12 +33,266 @@ import email.feedparser
 # line. We are only interesed in message headers :-)
 HEADER_BODY_SEPARATOR = '\r\n'
 
+# A header line starts with the header name and a colon, anything else
+# (that is no continuation line) ends the headers like the separator.
+# Same as email.feedparser.
+HEADER_RE = re.compile(r'[\041-\071\073-\176]+:')
+
+# RFC 2822 3.4
+# Tokens of an address list outside of comments, angle brackets and the
+# separators: whitespace, quoted strings, encoded words (RFC 2047, taken
+# as a whole, whatever they contain) and atoms.
+ADDRESS_TOKEN_RE = re.compile(r'''
+        \s+
+    |   "[^"\\]*(?:\\.[^"\\]*)*"?
+    |   =\?[^?\s]+\?[bBqQ]\?[^?\s]*\?=
+    |   [^\s"(,:;<]+
+''', re.VERBOSE)
+
+# The same for address lists without comments, groups and quoted local
+# parts (the common case), matching the addresses right away: angle
+# addresses and addresses standing on their own. Quoted strings and encoded
+# words are skipped.
+ADDRESS_RE = re.compile(r'''
+    [\s,;]*
+    (?: "[^"\\]*(?:\\.[^"\\]*)*"
+    |   =\?[^?\s]+\?[bBqQ]\?[^?\s]*\?=
+    |   <([^<>]*)>
+    |   (?<![^\s",;<>])([^\s",;<>]+@[^\s",;<>]+)(?=\s*(?:[,;]|$))
+    )
+''', re.VERBOSE)
+
+# Headers listing the primary recipients
+RECIPIENT_HEADERS = ('to', 'cc')
+
+# Characters an address is delimited by in a plain address list, before
+# and after it (see Message.lists_recipient)
+ADDRESS_BEFORE = frozenset(' \t\r\n<,:')
+ADDRESS_AFTER = frozenset(' \t\r\n>,;(')
+
+# Address lists an address may be listed in without being found as it is
+# contain comments or quoted pairs
+ADDRESS_OBSCURING = ('(', '\\')
+
+
+def parse_addresses(value):
+    '''Return the addresses of an address list (e.g. a To header value)
+
+    Display names, comments and group names are dropped, as is anything
+    that is no address. The addresses are returned as they are.'''
+
+    if '(' not in value and ':' not in value and '"@' not in value:
+        return [(angle or address).strip()
+                for angle, address in ADDRESS_RE.findall(value)
+                if '@' in angle or address]
+
+    addresses = []
+    words = []
+    angle = None
+    pos = 0
+    end = len(value)
+    while pos < end:
+        char = value[pos]
+        if char == ',' or char == ';':
+            _add_address(addresses, words, angle)
+            words = []
+            angle = None
+            pos += 1
+        elif char == '<':
+            close = value.find('>', pos)
+            if close < 0:
+                close = end
+            angle = value[pos + 1:close]
+            pos = close + 1
+        elif char == '(':
+            pos = _skip_comment(value, pos)
+        elif char == ':':
+            # The display name of a group
+            words = []
+            pos += 1
+        else:
+            match = ADDRESS_TOKEN_RE.match(value, pos)
+            if not char.isspace():
+                words.append(match.group())
+            pos = match.end()
+    _add_address(addresses, words, angle)
+    return addresses
+
+
+def _add_address(addresses, words, angle):
+    if angle is not None:
+        # Drop an obsolete source route (@relay,@relay:user@domain)
+        if angle.lstrip().startswith('@'):
+            angle = angle.partition(':')[2]
+        address = angle.strip()
+    else:
+        address = ''.join(words)
+    if '@' in address:
+        addresses.append(address)
 
-class Message(email.message.Message):
+
+def decode_value(value):
+    '''Return a header value with all encoded words decoded (RFC 2047),
+    as UTF-8. Undecodable words are kept as they are.'''
+
+    if '=?' not in value:
+        return value
+    try:
+        parts = decode_header(value)
+    except HeaderParseError:
+        return value
+    decoded = []
+    for part, charset in parts:
+        try:
+            decoded.append(part.decode(charset or 'ascii', 'replace'))
+        except LookupError:
+            # Unknown charset
+            decoded.append(part.decode('ascii', 'replace'))
+    return u' '.join(decoded).encode('utf-8')
+
+
+def _skip_comment(value, pos):
+    # Comments may nest, returns the position after the comment
+    depth = 0
+    end = len(value)
+    while pos < end:
+        char = value[pos]
+        if char == '\\':
+            pos += 1
+        elif char == '(':
+            depth += 1
+        elif char == ')':
+            depth -= 1
+            if not depth:
+                return pos + 1
+        pos += 1
+    return end
+
+
+def _find_address(lists, address):
+    # True if the address is found delimited like an address
+    pos = lists.find(address)
+    while pos >= 0:
+        end = pos + len(address)
+        if (pos == 0 or lists[pos - 1] in ADDRESS_BEFORE) \
+                and (end == len(lists) or lists[end] in ADDRESS_AFTER):
+            return True
+        pos = lists.find(address, pos + 1)
+    return False
+
+
+class Message(object):
+    '''The headers of a message
+
+    A compact stand-in for email.message.Message: headers are kept as a
+    list of (name, value) pairs in the order received, values are raw
+    (folded lines are kept as they are, encoded words are not decoded),
+    just like email.message.Message has them. Header names are looked up
+    case-insensitively.'''
 
     def __init__(self):
-        email.message.Message.__init__(self)
+        self._headers = []
+        self._index = {}
+        self._unixfrom = None
         self._unixto = None
+        self._recipients = None
+        self._recipient_lists = None
+        self._decoded = {}
+
+    def __len__(self):
+        return len(self._headers)
+
+    def __contains__(self, name):
+        return name.lower() in self._index
+
+    def __getitem__(self, name):
+        return self.get(name)
+
+    def __iter__(self):
+        for name, value in self._headers:
+            yield name
+
+    def add_header(self, name, value):
+        self._headers.append((name, value))
+        self._index.setdefault(name.lower(), value)
+
+    def get(self, name, failobj=None):
+        '''Return the value of the first header of that name'''
+
+        return self._index.get(name.lower(), failobj)
+
+    def get_all(self, name, failobj=None):
+        '''Return the values of all headers of that name'''
+
+        name = name.lower()
+        values = [v for k, v in self._headers if k.lower() == name]
+        return values or failobj
+
+    def keys(self):
+        return [name for name, value in self._headers]
+
+    def values(self):
+        return [value for name, value in self._headers]
+
+    def items(self):
+        return list(self._headers)
+
+    def get_decoded(self, index):
+        '''Return the decoded value of the header at that position (see
+        items), decoded only once when first asked for'''
+
+        decoded = self._decoded.get(index)
+        if decoded is None:
+            decoded = decode_value(self._headers[index][1])
+            self._decoded[index] = decoded
+        return decoded
+
+    def get_recipients(self):
+        '''Return the set of all addresses listed in the To and Cc headers,
+        in lower case. The headers are parsed only once.'''
+
+        if self._recipients is None:
+            recipients = set()
+            for name, value in self._headers:
+                if name.lower() in RECIPIENT_HEADERS:
+                    recipients.update(parse_addresses(value.lower()))
+            self._recipients = recipients
+        return self._recipients
+
+    def lists_recipient(self, address):
+        '''Return True if the address is listed in the To or Cc headers,
+        case-insensitive.
+
+        Most address lists are plain, so the header values are searched
+        first (as they are, then lower-cased): an address found delimited
+        like an address is listed, one not found at all is not. Only
+        otherwise (e.g. found within a quoted display name, or the lists
+        contain comments) the headers are parsed into the set of addresses,
+        see get_recipients.'''
+
+        if self._recipient_lists is None:
+            self._recipient_lists = ['\n'.join([value for name, value
+                    in self._headers if name.lower() in RECIPIENT_HEADERS]),
+                    None]
+        lists, folded = self._recipient_lists
+        if _find_address(lists, address):
+            return True
+
+        if folded is None:
+            folded = self._recipient_lists[1] = lists.lower()
+        address = address.lower()
+        if _find_address(folded, address):
+            return True
+        if address not in folded and not [part for part in ADDRESS_OBSCURING
+                if part in folded]:
+            return False
+        return address in self.get_recipients()
+
+    def set_unixfrom(self, address):
+        self._unixfrom = address
+
+    def get_unixfrom(self):
+        return self._unixfrom
 
     def set_unixto(self, address):
         self._unixto = address
@@ -45,41 +301,108 @@ class Message(email.message.Message):
         return self._unixto
 
 
-class BufferedInput(email.feedparser.BufferedSubFile):
+class Parser(object):
+    '''Streaming message header parser
 
-    def __init__(self):
-        email.feedparser.BufferedSubFile.__init__(self)
+    Feed the message in chunks of any size, the headers are parsed line
+    by line as soon as they are complete. Everything after the header
+    block (the body) is ignored, see headers_complete. close() returns
+    the message.
+
+    The header block may be limited in size (octets, line ends included),
+    number of header fields and length of a single line (0 is unlimited).
+    Parsing stops as soon as a limit is exceeded, like at the end of the
+    headers. overflow tells which limit then, the message holds the headers
+    parsed so far.'''
+
+    def __init__(self, _factory=Message, max_size=0, max_count=0,
+            max_line_length=0):
+        self._message = _factory()
+        self._partial = ''
+        self._name = None
+        self._value = []
+        self._size = 0
+        self.max_size = max_size
+        self.max_count = max_count
+        self.max_line_length = max_line_length
+        self.overflow = None
         self.headers_complete = False
 
-    def push(self, data):
-        data, self._partial = self._partial + data, ''
-        parts = email.feedparser.NLCRE_crack.split(data)
-        self._partial = parts.pop()
-        lines = []
-        for i in range(len(parts) // 2):
-            line = parts[i*2]
-            eol = parts[i*2+1]
-            if not line:
-                self.headers_complete = True
-                self._partial = ''
-                break
-            lines.append(line + eol)
-        self.pushlines(lines)
+    def feed(self, data):
+        if self.headers_complete:
+            return
+        if self._partial:
+            data = self._partial + data
+            self._partial = ''
+        start = 0
+        end = data.find('\n')
+        while end >= 0:
+            if not self._line(data[start:end + 1]):
+                self._end()
+                return
+            start = end + 1
+            end = data.find('\n', start)
+        self._partial = data[start:]
+        # Don't buffer a line that will exceed a limit anyway
+        length = len(self._partial)
+        if self.max_line_length and length > self.max_line_length:
+            self._overflow('line longer than %d octets'
+                    % self.max_line_length)
+        elif self.max_size and self._size + length > self.max_size:
+            self._overflow('header block larger than %d octets'
+                    % self.max_size)
 
+    def close(self):
+        if not self.headers_complete:
+            if self._partial and self._line(self._partial):
+                self._partial = ''
+            self._end()
+        return self._message
 
-class Parser(object, email.feedparser.FeedParser):
+    def _line(self, line):
+        # Returns False at the end of the headers
+        length = len(line)
+        self._size += length
+        if self.max_line_length and length > self.max_line_length:
+            return self._overflow('line longer than %d octets'
+                    % self.max_line_length)
+        if self.max_size and self._size > self.max_size:
+            return self._overflow('header block larger than %d octets'
+                    % self.max_size)
+        first = line[0]
+        if first == ' ' or first == '\t':
+            # Continuation of the previous header, kept as it is
+            if self._name is not None:
+                self._value.append(line)
+            return True
+        if first == '\r' or first == '\n':
+            return False
+        self._flush()
+        if self.max_count and len(self._message) >= self.max_count:
+            return self._overflow('more than %d header fields'
+                    % self.max_count)
+        match = HEADER_RE.match(line)
+        if match is None:
+            # Skip the envelope sender line of mbox messages, see
+            # set_unixfrom
+            return line.startswith('From ')
+        colon = match.end()
+        self._name = line[:colon - 1]
+        self._value = [line[colon:].lstrip()]
+        return True
 
-    def __init__(self, _factory=Message):
-        self._factory = _factory
-        self._input = BufferedInput()
-        self._msgstack = []
-        self._parse = self._parsegen().next
-        self._cur = None
-        self._last = None
-        self._headersonly = False
+    def _flush(self):
+        if self._name is not None:
+            self._message.add_header(self._name,
+                    ''.join(self._value).rstrip('\r\n'))
+            self._name = None
 
-    def feed(self, data):
-        if not self._input.headers_complete:
-            self._input.push(data)
-            self._call_parse()
+    def _overflow(self, limit):
+        self.overflow = limit
+        self._end()
+        return False
 
+    def _end(self):
+        self._flush()
+        self._partial = ''
+        self.headers_complete = True
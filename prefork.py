@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+
+'''Response Project - Pre-Forking Worker Supervisor'''
+
+# Copyright (C) 2009-2010 John Feuerstein <john@feurix.com>
+#
+# This file is part of the response project.
+#
+# Response is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# Response is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Library General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+# ---
+#
+# The listening socket is created (bound and listening) by the parent
+# before forking, so all workers inherit the very same file descriptor and
+# the kernel distributes incoming connections between the workers calling
+# accept() on it. The parent never serves connections itself, it only
+# supervises the workers.
+
+from globals import __author__, __copyright__, __license__, __version__
+
+import os
+import time
+import signal
+import errno
+import exception
+
+from logger import getModuleLog
+log = getModuleLog(__name__)
+
+
+# Don't restart workers more often than this (seconds), a worker dying
+# right after its start would cause a fork loop otherwise.
+RESPAWN_DELAY = 1
+
+# How long to wait for workers to exit after forwarding a signal before
+# killing them (seconds).
+SHUTDOWN_TIMEOUT = 10
+
+
+class Supervisor(object):
+    '''Run `target` in `workers` forked child processes, and `cleanup`
+    (if given) in each of them once `target` returned.
+
+    Dead workers are restarted. A signal received by the parent (raised
+    as exception.SignalReceived by the signal handler) is forwarded to all
+    workers before it is re-raised to the caller.
+    '''
+
+    def __init__(self, workers, target, cleanup=None):
+        self.count = workers
+        self.target = target
+        self.cleanup = cleanup
+        self.workers = {}
+
+    def run(self):
+        log.info('Starting %d worker processes' % self.count)
+        signal.signal(signal.SIGUSR1, self._forward)
+        try:
+            for i in range(self.count):
+                self._spawn()
+            while True:
+                try:
+                    pid, status = os.wait()
+                except OSError, e:
+                    # Interrupted by a forwarded signal
+                    if e.errno == errno.EINTR:
+                        continue
+                    raise
+                if pid not in self.workers:
+                    continue
+                started = self.workers.pop(pid)
+                log.error('Worker PID=%d died (status %d), restarting'
+                        % (pid, status))
+                if time.time() - started < RESPAWN_DELAY:
+                    time.sleep(RESPAWN_DELAY)
+                self._spawn()
+        except exception.SignalReceived, s:
+            self.stop(s.signum)
+            raise
+        except:
+            self.stop(signal.SIGTERM)
+            raise
+
+    def _forward(self, signum, frame):
+        # Not a reason to stop, just pass it on (e.g. SIGUSR1)
+        for pid in self.workers.keys():
+            try:
+                os.kill(pid, signum)
+            except OSError:
+                pass
+
+    def stop(self, signum):
+        log.info('Forwarding signal %d to %d worker processes'
+                % (signum, len(self.workers)))
+        for pid in self.workers.keys():
+            try:
+                os.kill(pid, signum)
+            except OSError:
+                self.workers.pop(pid)
+
+        deadline = time.time() + SHUTDOWN_TIMEOUT
+        while self.workers:
+            for pid in self.workers.keys():
+                try:
+                    if os.waitpid(pid, os.WNOHANG)[0] == 0:
+                        continue
+                except OSError:
+                    pass
+                self.workers.pop(pid)
+            if not self.workers:
+                break
+            if time.time() > deadline:
+                for pid in self.workers.keys():
+                    log.error('Worker PID=%d did not exit, killing it' % pid)
+                    try:
+                        os.kill(pid, signal.SIGKILL)
+                        os.waitpid(pid, 0)
+                    except OSError:
+                        pass
+                self.workers = {}
+                break
+            time.sleep(0.1)
+
+    def _spawn(self):
+        try:
+            pid = os.fork()
+        except OSError, e:
+            raise exception.DaemonError('Unable to fork(): %s [%d]'
+                    % (e.strerror, e.errno))
+
+        if pid != 0:
+            log.debug('Started worker PID=%d' % pid)
+            self.workers[pid] = time.time()
+            return
+
+        # Worker process: never return into the caller's stack, it belongs
+        # to the parent (pidfile handling, restart loop, ...)
+        signal.signal(signal.SIGUSR1, signal.SIG_IGN)
+        ret = 0
+        try:
+            try:
+                self.target()
+            except exception.SignalReceived, s:
+                log.debug('Worker PID=%d received signal %d'
+                        % (os.getpid(), s.signum))
+            except Exception, e:
+                log.error('Worker PID=%d died: %s' % (os.getpid(), e))
+                ret = 1
+        finally:
+            # Whatever the worker holds in memory (buffered records,
+            # statistics) is lost with os._exit()
+            try:
+                if self.cleanup:
+                    self.cleanup()
+            except Exception, e:
+                log.error('Worker PID=%d failed to clean up: %s'
+                        % (os.getpid(), e))
+                ret = 1
+            os._exit(ret)
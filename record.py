@@ -22,44 +22,253 @@
 
 from globals import __author__, __copyright__, __license__, __version__
 
+import time
+import threading
 import exception
 
+from datetime import datetime
+from helpers import LRUCache
 from logger import getModuleLog
 log = getModuleLog(__name__)
 
 
-def record_response(manager, message):
+class RecordBatch(object):
+    '''Response records written to the backend with a single query'''
+
+    def __init__(self):
+        # Repeated hits of the same pair fold into the latest one
+        self.hits = {}
+        self.callbacks = []
+        self.done = False
+        self.success = None
+
+    def __len__(self):
+        return len(self.hits)
+
+    @property
+    def records(self):
+        '''Sorted list of (sender, recipient, date) tuples'''
+
+        # A fixed order keeps concurrent upserts from deadlocking
+        return sorted((sender, recipient, date)
+                for (sender, recipient), date in self.hits.iteritems())
+
+    def notify(self, callback):
+        '''Call callback(success) as soon as the batch is written'''
+
+        if self.done:
+            callback(self.success)
+        else:
+            self.callbacks.append(callback)
+
+    def finish(self, success):
+        self.done = True
+        self.success = success
+        callbacks, self.callbacks = self.callbacks, []
+        for callback in callbacks:
+            callback(success)
+
+
+class RecordBuffer(object):
+    '''Write-behind buffer for response records
+
+    Records are gathered in the current batch (add is thread safe) until
+    the batch is due, i.e. it holds `size` records or its first record is
+    older than `interval` seconds. The owner then takes the batch and
+    writes it using record_batch(). notify() and finish() of a batch are
+    meant to be called from the same thread (the event loop).'''
+
+    def __init__(self, size, interval):
+        self.size = size
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.batch = RecordBatch()
+        self.started = None
+
+    def add(self, sender, recipient):
+        with self.lock:
+            if not self.batch.hits:
+                self.started = time.time()
+            self.batch.hits[(sender, recipient)] = datetime.now()
+            return self.batch
+
+    def due(self, now):
+        with self.lock:
+            records = len(self.batch)
+            return records >= self.size \
+                    or (records > 0 and now - self.started >= self.interval)
+
+    def take(self):
+        with self.lock:
+            batch, self.batch = self.batch, RecordBatch()
+            return batch
+
+
+class RecentHits(object):
+    '''Remember the (sender, recipient) pairs recorded within the last
+    `window` seconds, at most `size` of them (least recently hit pairs are
+    forgotten first).
+
+    The hit timestamp is all a repeated record would update, so writing it
+    again within a short window is not worth the row lock.'''
+
+    def __init__(self, size, window):
+        self.window = window
+        self.cache = LRUCache(size)
+
+    def seen(self, sender, recipient, now):
+        '''Return True if the pair was recorded within the window,
+        otherwise remember it as recorded now'''
+
+        last = self.cache.get((sender, recipient))
+        if last is not None and now - last < self.window:
+            return True
+        self.cache[(sender, recipient)] = now
+        return False
+
+    def forget(self, sender, recipient):
+        self.cache.pop((sender, recipient))
+
+
+class RecentDeliveries(object):
+    '''Remember the (Message-ID, recipient) pairs of the messages processed
+    within the last `window` seconds, at most `size` of them (least
+    recently delivered pairs are forgotten first).
+
+    Alias expansion and retries deliver copies of the same message for the
+    same recipient, only the first one needs to be validated and recorded.'''
+
+    def __init__(self, size, window):
+        self.window = window
+        self.cache = LRUCache(size)
+
+    def seen(self, message_id, recipient, now):
+        '''Return True if the message was processed for the recipient
+        within the window'''
+
+        last = self.cache.get((message_id, recipient))
+        return last is not None and now - last < self.window
+
+    def add(self, message_id, recipient, now):
+        self.cache[(message_id, recipient)] = now
+
+
+class SenderLimits(object):
+    '''Token bucket of every envelope sender: each recorded hit takes a
+    token, tokens come back at `rate` per second up to `burst`. At most
+    `size` senders are tracked (least recently seen senders are forgotten
+    first, and start over with a full bucket).
+
+    The hits refused in a row are counted, so they can be reported once
+    per sender and stretch over the limit instead of once per hit.'''
+
+    def __init__(self, rate, burst, size):
+        self.rate = rate
+        self.burst = burst
+        self.lock = threading.Lock()
+        self.cache = LRUCache(size)
+
+    def admit(self, sender, now):
+        '''Take a token if the sender has one left. Return whether a token
+        was taken and the number of hits refused in a row: including this
+        one if refused, before this one otherwise.'''
+
+        with self.lock:
+            tokens, last, refused = self.cache.get(sender,
+                    (self.burst, now, 0))
+            tokens = min(self.burst, tokens + (now - last) * self.rate)
+            if tokens < 1:
+                self.cache[sender] = (tokens, now, refused + 1)
+                return False, refused + 1
+            self.cache[sender] = (tokens - 1, now, 0)
+            return True, refused
+
+
+def record_batch(manager, records):
+    '''Write a list of (sender, recipient, date) response records using
+    one multi-row query, commit and release the backend connection.'''
+
+    log.debug('Writing batch of %d response records' % len(records))
+
+    try:
+        manager.record_responses(records)
+    except exception.DatabaseError:
+        manager.release(commit=False)
+        raise
+    except Exception, e:
+        manager.release(commit=False)
+        raise exception.RecordResponseError(
+                'Unable to record %d responses - %s' % (len(records), e))
+    manager.release()
+
+
+def record_response(manager, message, buffer=None, recent=None,
+        limits=None):
     '''Response recording / queuing:
 
     Given a validated message, record a new autoresponse record in the
     backend. If the record is already existing, update the timestamp of
     the last incoming message hitting this autoresponder.
 
-    Return: True if success, False if failure'''
+    If a write-behind buffer is given, the record is only added to the
+    buffer and the batch it will be written with is returned.
+
+    Given the recently recorded hits, repeated hits within their window
+    are not recorded at all. Given the sender limits, neither are hits of
+    a sender beyond its rate limit.'''
 
     # Swap sender and recipient
     sender = message.get_unixto()
     recipient = message.get_unixfrom()
 
+    if recent is not None and recent.seen(sender, recipient, time.time()):
+        log.info('Recently recorded response: %s -> %s' % (sender, recipient))
+        return
+
+    if limits is not None:
+        admitted, refused = limits.admit(recipient, time.time())
+        if not admitted:
+            if refused == 1:
+                log.warning('Sender %s exceeds the rate limit, not recording '
+                        'its hits for now' % recipient)
+            log.info('Rate limited response: %s -> %s' % (sender, recipient))
+            if recent is not None:
+                recent.forget(sender, recipient)
+            return
+        if refused:
+            log.warning('Sender %s is within the rate limit again, %d hits '
+                    'were not recorded' % (recipient, refused))
+
+    if buffer is not None:
+        log.info('Buffering response: %s -> %s' % (sender, recipient))
+        return buffer.add(sender, recipient)
+
     log.info('Recording response: %s -> %s' % (sender, recipient))
 
     try:
         manager.record_response(sender, recipient)
         log.debug('Response record successful!')
+    except exception.DatabaseError:
+        # Backend unavailable
+        if recent is not None:
+            recent.forget(sender, recipient)
+        raise
     except Exception, e:
         log.debug('Response record failed!')
+        if recent is not None:
+            recent.forget(sender, recipient)
         raise exception.RecordResponseError(
                 'Unable to record response: %s -> %s - %s'
                 % (sender, recipient, e))
 
 
-def record(manager, message):
+def record(manager, message, buffer=None, recent=None, limits=None):
     '''Record or update an autoresponse'''
 
     log.debug('Adding/updating autoresponse record')
 
     try:
-        record_response(manager, message)
+        return record_response(manager, message, buffer, recent, limits)
     except exception.RecordError, e:
         log.info('Response record (%s -> %s) failed: %s'
                 % (message.get_unixfrom(), message.get_unixto(), e))
@@ -0,0 +1,876 @@
+# -*- coding: utf-8 -*-
+
+'''Response Project - Compiled Validation Rules'''
+
+# Copyright (C) 2009-2010 John Feuerstein <john@feurix.com>
+#
+# This file is part of the response project.
+#
+# Response is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# Response is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Library General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+# ---
+#
+# A RuleSet is compiled once, either from the built-in rule lists (see
+# validate.py) or from a rules file, and never changed afterwards. A new
+# RuleSet replaces the old one as a whole (see validate.load_rules), so a
+# message is always validated against one consistent set of rules.
+#
+# Rules file format (see rules.cfg), one regular expression per line of
+# the RULES option, lines starting with # are comments:
+#
+#   [address:<group>]        Address rules of a group
+#   APPLY = sender recipient  Envelope addresses the group applies to
+#   RULES = ...
+#
+#   [header-name:<group>]    Header name rules of a group
+#   RULES = ...
+#
+#   [header-value:<group>]   Header value rules of a group
+#   HEADER = ...              Header names the value rules apply to
+#   RULES = ...
+#
+#   [domains:<group>]        Domains of a group, with all their subdomains
+#   APPLY = sender recipient  Envelope addresses the group applies to
+#   DOMAINS = ...             One domain per line
+#   FILE = ...                Files listing one domain per line, relative
+#                             to the rules file
+#
+# All rule sections take IGNORECASE = True/False (default: True).
+#
+# With a Profile, the time, calls and matches of every rule are counted.
+# The expressions are matched one by one then (on verdict cache misses),
+# which costs more than the combined matching it replaces. Header rules
+# are only matched once per distinct header name (see HeaderRules).
+
+from globals import __author__, __copyright__, __license__, __version__
+
+import os
+import re
+import time
+import threading
+import sre_parse
+import sre_constants
+import exception
+
+from ConfigParser import RawConfigParser, Error as ConfigParserError
+from helpers import LRUCache
+from logger import getModuleLog
+log = getModuleLog(__name__)
+
+
+# Flags that may differ between the regular expressions combined into one
+FLAGS_IGNORED = re.VERBOSE
+
+# Regular expressions that can't be part of a combined one: backreferences
+# and inline flags (which would apply to all of them).
+UNCOMBINABLE_RE = re.compile(r'\\[1-9]|\(\?P=|\(\?[iLmsux]+\)')
+
+# Cached "no match" verdicts are None, tell them from cache misses
+NO_VERDICT = object()
+
+# Number of distinct header names to remember the rules for
+HEADER_NAME_CACHE_SIZE = 4096
+
+# Limits of the expansion of a regular expression into a LinearPattern
+LINEAR_MAX_ALTERNATIVES = 256
+LINEAR_MAX_CHAINS = 16
+LINEAR_MAX_REPEAT = 4
+LINEAR_MAX_RANGE = 32
+
+
+class Profile(object):
+    '''Cumulative calls, time and matches of rules and validation stages,
+    shared by all threads of a process. Keys are (kind, group, pattern)
+    tuples, pattern is None for validation stages.'''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.started = time.time()
+
+    def add(self, key, elapsed, matched):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                entry = self.entries[key] = [0, 0.0, 0]
+            entry[0] += 1
+            entry[1] += elapsed
+            if matched:
+                entry[2] += 1
+
+    def call(self, key, function, *args):
+        '''Run function(*args), a ValidationError counts as a match'''
+
+        start = time.time()
+        try:
+            result = function(*args)
+        except exception.ValidationError:
+            self.add(key, time.time() - start, True)
+            raise
+        self.add(key, time.time() - start, False)
+        return result
+
+    def report(self):
+        '''Return (key, calls, time, matches) of all entries, the most
+        time consuming first'''
+
+        with self.lock:
+            report = [(key, calls, elapsed, matches) for key,
+                    (calls, elapsed, matches) in self.entries.iteritems()]
+        report.sort(key=lambda entry: entry[2], reverse=True)
+        return report
+
+
+class DomainSuffixes(object):
+    '''Index of domains, matching the domains and all their subdomains
+
+    The index is a tree of the reversed domain labels (com -> example), so
+    a lookup costs one dict lookup per label of the domain looked up, no
+    matter how many domains are listed. Unlike a regular expression like
+    `.*@.*example.*`, labels never match a part of another label.'''
+
+    # Key of the value of a listed domain, never a label
+    LISTED = None
+
+    def __init__(self):
+        self.root = {}
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def add(self, domain, value=True):
+        node = self.root
+        for label in reversed(domain.lower().strip('.').split('.')):
+            node = node.setdefault(label, {})
+        if self.LISTED not in node:
+            self.count += 1
+        node[self.LISTED] = value
+
+    def lookup(self, domain):
+        '''Return the value of the listed domain that domain is part of,
+        or None'''
+
+        node = self.root
+        for label in reversed(domain.lower().rstrip('.').split('.')):
+            node = node.get(label)
+            if node is None:
+                return None
+            if self.LISTED in node:
+                return node[self.LISTED]
+        return None
+
+
+def read_domains(filename):
+    '''Return the domains listed in a file, one per line. Everything after
+    a # is a comment, a leading `*.` or `.` is ignored.'''
+
+    domains = []
+    for line in open(filename):
+        line = line.split('#', 1)[0].strip()
+        if line:
+            domains.append(parse_domain(line, filename))
+    return domains
+
+
+def parse_domain(domain, source):
+    domain = domain.lower()
+    if domain.startswith('*.'):
+        domain = domain[2:]
+    domain = domain.strip('.')
+    if not domain or '@' in domain or len(domain.split()) > 1 \
+            or '' in domain.split('.'):
+        raise exception.ConfigError('Invalid domain in %s: %s'
+                % (source, domain))
+    return domain
+
+
+class LinearPattern(object):
+    '''Linear-time equivalent of a regular expression's match()
+
+    Address rules like `.*not?.*reply.*@` backtrack polynomially on long
+    hostile addresses. Many of them are just chains of fixed-length pieces
+    (literals, alternations, optional parts, `.`) glued together with `.*`
+    though. Such a chain matches if each piece is found after the end of
+    the previous one, and the occurrence that ends first is always good
+    enough. So every piece costs a few str.find() over the first line
+    (`.` never matches a newline), whatever the input.
+
+    compile() returns None for everything else (repetitions other than
+    `.*` and small bounded ones, classes like `\\w`, anchors other than
+    a final `$`, ...), those stay regular expressions.'''
+
+    # Token of an expanded regular expression besides literal characters
+    ANY = object()
+
+    class Unsupported(Exception):
+        pass
+
+    def __init__(self, regexp, chains, end):
+        self.pattern = regexp.pattern
+        self.fold = bool(regexp.flags & re.IGNORECASE)
+        self.end = end
+        self.chains = []
+        for chain in chains:
+            segments = [self._segment(alternatives) for alternatives in chain]
+            # Trailing segments matching the empty string are always found
+            while not end and len(segments) > 1 and segments[-1][0]:
+                segments.pop()
+            self.chains.append(segments)
+
+    @classmethod
+    def compile(cls, regexp):
+        '''Return the LinearPattern of a compiled regular expression or
+        None if there is no such thing'''
+
+        if regexp.flags & (re.DOTALL | re.MULTILINE | re.LOCALE | re.UNICODE):
+            return None
+        try:
+            nodes = list(sre_parse.parse(regexp.pattern, regexp.flags))
+            end = nodes[-1:] == [(sre_constants.AT, sre_constants.AT_END)]
+            if end:
+                nodes.pop()
+            return cls(regexp, cls._expand(nodes), end)
+        except (cls.Unsupported, sre_constants.error):
+            return None
+
+    @classmethod
+    def _expand(cls, nodes):
+        '''Expand parsed nodes into a list of chains. A chain is a list
+        of segments separated by `.*`, a segment a list of alternative
+        token tuples.'''
+
+        options = [[[()]]]
+        for op, av in nodes:
+            options = cls._concat(options, cls._node(op, av))
+        return options
+
+    @classmethod
+    def _concat(cls, heads, tails):
+        options = []
+        for head in heads:
+            for tail in tails:
+                joined = [first + second
+                        for first in head[-1] for second in tail[0]]
+                if len(joined) > LINEAR_MAX_ALTERNATIVES:
+                    raise cls.Unsupported()
+                options.append(head[:-1] + [joined] + tail[1:])
+        return cls._merge(options)
+
+    @classmethod
+    def _merge(cls, options):
+        '''Merge the options without `.*` into one, drop duplicates'''
+
+        merged = []
+        single = []
+        for option in options:
+            if len(option) == 1:
+                single.extend(alternative for alternative in option[0]
+                        if alternative not in single)
+            elif option not in merged:
+                merged.append(option)
+        if single:
+            merged.insert(0, [single])
+        if len(merged) > LINEAR_MAX_CHAINS \
+                or len(single) > LINEAR_MAX_ALTERNATIVES:
+            raise cls.Unsupported()
+        return merged
+
+    @classmethod
+    def _node(cls, op, av):
+        if op is sre_constants.LITERAL and av != ord('\n'):
+            return [[[(chr(av),)]]]
+        if op is sre_constants.ANY:
+            return [[[(cls.ANY,)]]]
+        if op is sre_constants.IN:
+            chars = set()
+            for item, value in av:
+                if item is sre_constants.LITERAL:
+                    chars.add(chr(value))
+                elif item is sre_constants.RANGE \
+                        and value[1] - value[0] < LINEAR_MAX_RANGE:
+                    chars.update(chr(c) for c in range(value[0], value[1] + 1))
+                else:
+                    raise cls.Unsupported()
+            chars.discard('\n')
+            return [[[(char,) for char in sorted(chars)]]]
+        if op is sre_constants.SUBPATTERN:
+            return cls._expand(av[1])
+        if op is sre_constants.BRANCH:
+            options = []
+            for branch in av[1]:
+                options.extend(cls._expand(branch))
+            return cls._merge(options)
+        if op in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT):
+            low, high, nodes = av
+            if high == sre_constants.MAXREPEAT:
+                if list(nodes) != [(sre_constants.ANY, None)]:
+                    raise cls.Unsupported()
+                return [[[(cls.ANY,) * low], [()]]]
+            if high > LINEAR_MAX_REPEAT:
+                raise cls.Unsupported()
+            once = cls._expand(nodes)
+            options = []
+            repeated = [[[()]]]
+            for count in range(high + 1):
+                if count >= low:
+                    options.extend(repeated)
+                repeated = cls._concat(repeated, once)
+            return cls._merge(options)
+        raise cls.Unsupported()
+
+    def _segment(self, alternatives):
+        '''Return (whether the segment matches the empty string, list of
+        (matcher, length) of the other alternatives, the same without those
+        never ending first, one regular expression matching them all,
+        whether a search() for that one always finds the occurrence that
+        ends first)
+
+        Matchers are strings for literals, regular expressions for
+        alternatives with `.`. The regular expression tries the shortest
+        alternatives first.'''
+
+        empty = () in alternatives
+        alternatives = sorted(set(alternative for alternative in alternatives
+                if alternative), key=len)
+        if not alternatives:
+            return empty, [], [], None, False
+
+        patterns = []
+        matchers = []
+        for alternative in alternatives:
+            pattern = ''.join(token is self.ANY and '.' or re.escape(
+                    self.fold and token.lower() or token)
+                    for token in alternative)
+            patterns.append(pattern)
+            if self.ANY in alternative:
+                matchers.append((re.compile(pattern), len(alternative)))
+            else:
+                text = ''.join(alternative)
+                matchers.append((self.fold and text.lower() or text,
+                        len(alternative)))
+
+        # An occurrence of a literal containing another one never ends first
+        texts = [matcher for matcher, length in matchers
+                if isinstance(matcher, str)]
+        earliest = [(matcher, length) for matcher, length in matchers
+                if not isinstance(matcher, str) or not [text for text in texts
+                        if text != matcher and text in matcher]]
+        exact = len(set(length for matcher, length in earliest)) == 1
+
+        return (empty, matchers, earliest, re.compile('|'.join(patterns)),
+                exact)
+
+    def match(self, string):
+        line = string.split('\n', 1)[0]
+        if self.end and len(string) > len(line) \
+                and string[len(line):] != '\n':
+            # $ is only found at the end or before a final newline
+            return False
+        if self.fold:
+            line = line.lower()
+        for chain in self.chains:
+            if self._chain(chain, line):
+                return True
+        return False
+
+    def _chain(self, chain, line):
+        last = len(chain) - 1
+        pos = 0
+        for index, (empty, matchers, earliest, regexp, exact) \
+                in enumerate(chain):
+            if index == last and self.end:
+                return self._ends(empty, matchers, line, pos, index == 0)
+            if empty:
+                continue
+            if index == 0:
+                # Anchored at the start of the line, shortest first
+                match = regexp.match(line)
+            elif index == last or exact:
+                # Only has to be found, or the first one found ends first
+                match = regexp.search(line, pos)
+            else:
+                pos = self._earliest(earliest, line, pos)
+                if pos < 0:
+                    return False
+                continue
+            if match is None:
+                return False
+            pos = match.end()
+        return True
+
+    def _earliest(self, matchers, line, pos):
+        '''Return the end of the occurrence that ends first or -1'''
+
+        found = -1
+        for matcher, length in matchers:
+            if isinstance(matcher, str):
+                start = line.find(matcher, pos)
+            else:
+                match = matcher.search(line, pos)
+                start = -1
+                if match is not None:
+                    start = match.start()
+            if start >= 0 and (found < 0 or start + length < found):
+                found = start + length
+        return found
+
+    def _ends(self, empty, matchers, line, pos, anchored):
+        if empty and not (anchored and line):
+            return True
+        for matcher, length in matchers:
+            start = len(line) - length
+            if start < pos or anchored and start != 0:
+                continue
+            if isinstance(matcher, str):
+                if line.endswith(matcher):
+                    return True
+            elif matcher.match(line, start):
+                return True
+        return False
+
+
+class RegexpMatcher(object):
+    '''Match a string against a list of regular expressions at once
+
+    The regular expressions are combined into as few alternations as
+    possible (one per run of expressions with compatible flags), each of
+    them a named group, so a valid string - the common case - costs one
+    match() per run instead of one per expression. match() returns the
+    index of the first matching expression of the list, i.e. the same one
+    a loop over the list would find first, or None.
+
+    With a cache_size, the verdicts of up to that many strings are cached.
+    The cache belongs to the compiled expressions, compile() starts with
+    an empty one.
+
+    With linear, expressions with a LinearPattern are matched using that
+    one by one instead, so no string takes more than linear time.'''
+
+    def __init__(self, regexps, groups=(), default=None, cache_size=0,
+            linear=False):
+        self.regexps = list(regexps)
+        self.name = default
+        self.cache_size = cache_size
+        self.linear = linear
+        self.matchers = self.regexps
+        self.cache = None
+        self.profile = None
+        self.keys = None
+        self.labels = [default] * len(self.regexps)
+        for label, members in groups:
+            members = set(id(regexp) for regexp in members)
+            for index, regexp in enumerate(self.regexps):
+                if id(regexp) in members:
+                    self.labels[index] = label
+        self.runs = []
+        self.compile()
+
+    def group(self, index):
+        '''Return the label of the rule group the expression belongs to'''
+
+        return self.labels[index]
+
+    def set_profile(self, profile, keys):
+        '''Count each expression in profile, using the given keys'''
+
+        self.profile = profile
+        self.keys = keys
+
+    def compile(self):
+        self.cache = None
+        if self.cache_size > 0:
+            self.cache = LRUCache(self.cache_size)
+
+        # Whatever matches a single expression best
+        self.matchers = list(self.regexps)
+        if self.linear:
+            for index, regexp in enumerate(self.regexps):
+                self.matchers[index] = LinearPattern.compile(regexp) or regexp
+                if self.matchers[index] is regexp:
+                    log.debug('No linear-time matching for %s rule %r'
+                            % (self.group(index), regexp.pattern))
+
+        runs = []
+        key = None
+        for index, regexp in enumerate(self.regexps):
+            if self.matchers[index] is not regexp \
+                    or UNCOMBINABLE_RE.search(regexp.pattern) \
+                    or regexp.groupindex:
+                runs.append((None, [index]))
+                key = None
+                continue
+            flags = regexp.flags & ~FLAGS_IGNORED
+            if regexp.pattern.lower() == regexp.pattern.upper():
+                # Nothing to ignore the case of
+                flags |= re.IGNORECASE
+            if flags != key:
+                runs.append((flags, []))
+                key = flags
+            runs[-1][1].append(index)
+
+        self.runs = []
+        for flags, indexes in runs:
+            if flags is None or len(indexes) == 1:
+                self.runs.append((self.matchers[indexes[0]], indexes[0]))
+                continue
+            # Always combine verbose, the newline ends trailing comments
+            pattern = '|'.join('(?P<r%d>%s\n)'
+                    % (index, self._verbose(self.regexps[index]))
+                    for index in indexes)
+            self.runs.append((re.compile(pattern, flags | re.VERBOSE), None))
+
+    def _verbose(self, regexp):
+        '''Return the pattern with the same meaning in verbose mode'''
+
+        if regexp.flags & re.VERBOSE:
+            return regexp.pattern
+        pattern = []
+        escaped = False
+        for char in regexp.pattern:
+            if not escaped and (char.isspace() or char == '#'):
+                pattern.append('\\')
+            escaped = not escaped and char == '\\'
+            pattern.append(char)
+        return ''.join(pattern)
+
+    def match(self, string):
+        if self.cache is None:
+            return self._match(string)
+        index = self.cache.get(string, NO_VERDICT)
+        if index is NO_VERDICT:
+            index = self._match(string)
+            self.cache[string] = index
+        return index
+
+    def _match(self, string):
+        if self.profile is not None:
+            return self._profile_match(string)
+        for regexp, index in self.runs:
+            match = regexp.match(string)
+            if match:
+                if index is None:
+                    index = int(match.lastgroup[1:])
+                return index
+        return None
+
+    def _profile_match(self, string):
+        for index, matcher in enumerate(self.matchers):
+            start = time.time()
+            match = matcher.match(string)
+            self.profile.add(self.keys[index], time.time() - start,
+                    bool(match))
+            if match:
+                return index
+        return None
+
+
+class HeaderRules(object):
+    '''Index of the header name and value rules
+
+    Whether a header name is invalid and which value rules apply to it
+    only depends on the name, so this is computed once per distinct name
+    (using a combined name matcher) and looked up from then on. Messages
+    repeat the same few names (Received, DKIM-Signature, ...) a lot.
+
+    Names are looked up lower-cased if all name expressions ignore the
+    case anyway. The index is a plain dict (no locking needed for lookups)
+    and starts over once it holds `size` names. Hits are counted under a
+    lock, the rules are shared by all backend threads.'''
+
+    def __init__(self, name_regexps, value_rules, size=HEADER_NAME_CACHE_SIZE):
+        self.name_matcher = RegexpMatcher(name_regexps)
+        self.value_rules = value_rules
+        self.value_regexps = []
+        for name_regexp, value_regexps in value_rules:
+            self.value_regexps.extend(value_regexps)
+        self.name_hits = [0] * len(self.name_matcher.regexps)
+        self.value_hits = [0] * len(self.value_regexps)
+        self.lock = threading.Lock()
+        self.size = size
+        self.names = {}
+        self.profile = None
+        self.value_keys = None
+        self.fold = all(regexp.flags & re.IGNORECASE
+                for regexp in list(name_regexps)
+                        + [name for name, values in value_rules])
+
+    def set_profile(self, profile, name_keys, value_keys):
+        self.name_matcher.set_profile(profile, name_keys)
+        self.profile = profile
+        self.value_keys = value_keys
+        self.names = {}
+
+    def lookup(self, name):
+        '''Return (index of the matching name rule or None, value matcher
+        or None, indexes of the value rules of the matcher)'''
+
+        key = self.fold and name.lower() or name
+        rules = self.names.get(key)
+        if rules is None:
+            values = []
+            offset = 0
+            for name_regexp, value_regexps in self.value_rules:
+                if name_regexp.match(name):
+                    values.extend(range(offset, offset + len(value_regexps)))
+                offset += len(value_regexps)
+            matcher = None
+            if values:
+                matcher = RegexpMatcher(
+                        [self.value_regexps[index] for index in values])
+                if self.profile is not None:
+                    matcher.set_profile(self.profile,
+                            [self.value_keys[index] for index in values])
+            rules = (self.name_matcher.match(name), matcher, values)
+            if len(self.names) >= self.size:
+                self.names = {}
+            self.names[key] = rules
+        return rules
+
+    def invalid_name(self, name):
+        index = self.lookup(name)[0]
+        if index is None:
+            return False
+        with self.lock:
+            self.name_hits[index] += 1
+        return True
+
+    def invalid_value(self, name, value):
+        name_index, matcher, values = self.lookup(name)
+        if matcher is None:
+            return False
+        index = matcher.match(value)
+        if index is None:
+            return False
+        with self.lock:
+            self.value_hits[values[index]] += 1
+        return True
+
+
+class RuleSet(object):
+    '''All validation rules, compiled
+
+    Address rules are given as lists of compiled regular expressions,
+    header value rules as a list of (name regexp, [value regexps]) pairs.
+    groups is a list of (label, [regexps]) pairs naming the rule groups,
+    domains a list of (label, [sender and/or recipient], [domains]). The
+    domains are looked up before the address rules are matched.
+
+    Every rule counts its hits (see stats, counted under a lock as the
+    rules are shared by all backend threads), with a Profile its calls and
+    time, too. With linear, address rules are matched in linear time where
+    possible (see LinearPattern). files lists the files the rules were
+    loaded from.'''
+
+    def __init__(self, sender, recipient, header_names, header_values,
+            groups=(), cache_size=0, source='built-in', profile=None,
+            linear=False, domains=(), files=()):
+        self.source = source
+        self.files = list(files)
+        self.groups = groups
+        self.profile = profile
+        self.sender_domains = DomainSuffixes()
+        self.recipient_domains = DomainSuffixes()
+        self.lock = threading.Lock()
+        self.domain_hits = {}
+        self.domain_counts = {}
+        for label, apply, listed in domains:
+            for kind, index in [
+                    ('sender', self.sender_domains),
+                    ('recipient', self.recipient_domains),
+                    ]:
+                if kind in apply:
+                    for domain in listed:
+                        index.add(domain, (label, domain))
+                    self.domain_hits[(kind, label)] = 0
+                    self.domain_counts[(kind, label)] = len(listed)
+        self.sender = RegexpMatcher(sender, groups, 'sender', cache_size,
+                linear)
+        self.recipient = RegexpMatcher(recipient, groups, 'recipient',
+                cache_size, linear)
+        self.headers = HeaderRules(header_names, header_values)
+        self.sender_hits = [0] * len(self.sender.regexps)
+        self.recipient_hits = [0] * len(self.recipient.regexps)
+
+        if profile is not None:
+            self.sender.set_profile(profile,
+                    self.keys('sender', self.sender.regexps))
+            self.recipient.set_profile(profile,
+                    self.keys('recipient', self.recipient.regexps))
+            self.headers.set_profile(profile,
+                    self.keys('header-name', self.headers.name_matcher.regexps),
+                    self.keys('header-value', self.headers.value_regexps))
+
+    def __len__(self):
+        return len(self.sender.regexps) + len(self.recipient.regexps) \
+                + len(self.headers.name_hits) + len(self.headers.value_hits)
+
+    def match_sender(self, sender):
+        '''Return a description of the first matching sender rule or None'''
+
+        return self._match_address('sender', sender, self.sender_domains,
+                self.sender, self.sender_hits)
+
+    def match_recipient(self, recipient):
+        '''Return a description of the first matching recipient rule or
+        None'''
+
+        return self._match_address('recipient', recipient,
+                self.recipient_domains, self.recipient, self.recipient_hits)
+
+    def _match_address(self, kind, address, domains, matcher, hits):
+        if len(domains) and '@' in address:
+            if self.profile is None:
+                listed = domains.lookup(address.rpartition('@')[2])
+            else:
+                start = time.time()
+                listed = domains.lookup(address.rpartition('@')[2])
+                self.profile.add((kind, 'domains', '%d domains'
+                        % len(domains)), time.time() - start, listed)
+            if listed is not None:
+                label, domain = listed
+                with self.lock:
+                    self.domain_hits[(kind, label)] += 1
+                return '%s domain %s' % (label, domain)
+
+        index = matcher.match(address)
+        if index is None:
+            return None
+        with self.lock:
+            hits[index] += 1
+        return '%s rule %d' % (matcher.group(index), index)
+
+    def label(self, regexp):
+        '''Return the name of the rule group the expression belongs to'''
+
+        for label, members in self.groups:
+            for member in members:
+                if member is regexp:
+                    return label
+        return None
+
+    def keys(self, kind, regexps):
+        '''Return the (kind, group, pattern) of each expression'''
+
+        return [(kind, self.label(regexp), ' '.join(regexp.pattern.split()))
+                for regexp in regexps]
+
+    def stats(self):
+        '''Return (kind, group, pattern, hits) of all rules'''
+
+        stats = []
+        for kind, regexps, hits in [
+                ('sender', self.sender.regexps, self.sender_hits),
+                ('recipient', self.recipient.regexps, self.recipient_hits),
+                ('header-name', self.headers.name_matcher.regexps,
+                    self.headers.name_hits),
+                ('header-value', self.headers.value_regexps,
+                    self.headers.value_hits),
+                ]:
+            for key, count in zip(self.keys(kind, regexps), hits):
+                stats.append(key + (count,))
+        for (kind, label), count in sorted(self.domain_counts.items()):
+            stats.append((kind, label, '%d domains' % count,
+                    self.domain_hits[(kind, label)]))
+        return stats
+
+    def cache_stats(self):
+        '''Return (name, size, hits, misses) of each address matcher cache'''
+
+        return [(matcher.name, len(matcher.cache), matcher.cache.hits,
+                matcher.cache.misses)
+                for matcher in (self.sender, self.recipient)
+                if matcher.cache is not None]
+
+    @classmethod
+    def load(cls, filename, cache_size=0, profile=None, linear=False):
+        '''Compile the rules of a rules file'''
+
+        parser = RawConfigParser()
+        try:
+            if not parser.read(filename):
+                raise exception.ConfigError('Unable to read rules file %s'
+                        % filename)
+            return cls._parse(parser, filename, cache_size, profile, linear)
+        except ConfigParserError, e:
+            raise exception.ConfigError('Invalid rules file %s: %s'
+                    % (filename, e))
+        except re.error, e:
+            raise exception.ConfigError('Invalid rule in %s: %s'
+                    % (filename, e))
+
+    @classmethod
+    def _parse(cls, parser, filename, cache_size, profile, linear):
+        sender = []
+        recipient = []
+        header_names = []
+        header_values = []
+        groups = []
+        domains = []
+        files = [filename]
+
+        for section in parser.sections():
+            kind, sep, group = section.partition(':')
+            if kind in ('address', 'domains'):
+                apply = parser.get(section, 'APPLY').lower().split()
+                if not apply or set(apply) - set(['sender', 'recipient']):
+                    raise exception.ConfigError('Invalid APPLY in [%s] of %s'
+                            % (section, filename))
+
+            if kind == 'domains':
+                listed = []
+                if parser.has_option(section, 'DOMAINS'):
+                    listed.extend(parse_domain(line, filename) for line
+                            in parser.get(section, 'DOMAINS').splitlines()
+                            if line.strip() and not line.startswith('#'))
+                if parser.has_option(section, 'FILE'):
+                    for name in parser.get(section, 'FILE').split():
+                        name = os.path.join(os.path.dirname(filename), name)
+                        try:
+                            listed.extend(read_domains(name))
+                        except IOError, e:
+                            raise exception.ConfigError(
+                                    'Unable to read domains of [%s] in %s: %s'
+                                    % (section, filename, e))
+                        files.append(name)
+                domains.append((group or kind, apply, listed))
+                continue
+
+            flags = 0
+            if not parser.has_option(section, 'IGNORECASE') \
+                    or parser.getboolean(section, 'IGNORECASE'):
+                flags = re.IGNORECASE
+            regexps = [re.compile(line, flags)
+                    for line in parser.get(section, 'RULES').splitlines()
+                    if line.strip() and not line.startswith('#')]
+            groups.append((group or kind, regexps))
+
+            if kind == 'address':
+                if 'sender' in apply:
+                    sender.extend(regexps)
+                if 'recipient' in apply:
+                    recipient.extend(regexps)
+            elif kind == 'header-name':
+                header_names.extend(regexps)
+            elif kind == 'header-value':
+                header_values.append((
+                    re.compile(parser.get(section, 'HEADER'), flags),
+                    regexps))
+            else:
+                raise exception.ConfigError('Unknown section [%s] in %s'
+                        % (section, filename))
+
+        return cls(sender, recipient, header_names, header_values, groups,
+                cache_size, filename, profile, linear, domains, files)
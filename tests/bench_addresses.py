@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+
+'''Primary recipient check benchmark and regression test
+
+Checks mail.parse_addresses against a list of address lists with known
+addresses, and mail.Message.lists_recipient against the parsed addresses.
+The script exits with status 1 if any differs.
+
+Then compares the cost of the primary recipient check (is the envelope
+recipient listed in To or Cc?) for messages with growing Cc lists: the
+substring test validate.py used to do per recipient, parsing the headers
+once and looking up every recipient in the set of addresses
+(mail.Message.get_recipients), and searching the header values first
+(mail.Message.lists_recipient, what validate.py does).'''
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from optparse import OptionParser
+
+import mail
+
+parser = OptionParser(usage='Usage: %prog [options]')
+parser.add_option('-n', '--rounds', dest='rounds', type='int', default=20,
+        help='rounds per measurement (default: 20)')
+parser.add_option('-r', '--recipients', dest='recipients', type='int',
+        default=5, help='envelope recipients per message (default: 5)')
+
+(options, args) = parser.parse_args()
+
+# Address list, addresses
+CORPUS = [
+    ('jane@example.com', ['jane@example.com']),
+    ('Jane Roe <jane@example.com>, "Doe, John" <john@example.com>',
+        ['jane@example.com', 'john@example.com']),
+    ('=?utf-8?q?Doe,_J=C3=BCrgen?= <juergen@example.com>, x@example.com',
+        ['juergen@example.com', 'x@example.com']),
+    ('undisclosed-recipients:;', []),
+    ('Friends: a@example.com, Bob <b@example.com>;, c@example.com',
+        ['a@example.com', 'b@example.com', 'c@example.com']),
+    ('john (the (nested) man, really) @ example.com', ['john@example.com']),
+    ('<@relay.example.net:joe@example.com>', ['joe@example.com']),
+    ('joe@example.com.example.org', ['joe@example.com.example.org']),
+    ('"joe doe"@example.com', ['"joe doe"@example.com']),
+    ('Jane Roe <jane@example.com>,\r\n\tJohn <john@example.com>',
+        ['jane@example.com', 'john@example.com']),
+    ('a@example.com,, ,b@example.com', ['a@example.com', 'b@example.com']),
+    ('Jane Roe', []),
+    ('"jane@example.com" <john@example.com>', ['john@example.com']),
+    ('john@example.com (jane@example.com)', ['john@example.com']),
+    ('xjane@example.com, jane@example.com.example.org',
+        ['xjane@example.com', 'jane@example.com.example.org']),
+]
+
+# Addresses to look up in every address list of the corpus
+LOOKUPS = ['jane@example.com', 'john@example.com', 'JANE@example.COM',
+        'b@example.com']
+
+
+def substring_check(message, recipient):
+    return recipient in message.get('To', failobj='') \
+            or recipient in message.get('Cc', failobj='')
+
+
+def set_check(message, recipient):
+    return recipient.lower() in message.get_recipients()
+
+
+def listed_check(message, recipient):
+    return message.lists_recipient(recipient)
+
+
+def build(cc):
+    message = mail.Message()
+    message.add_header('To', 'Jane Roe <jane@example.com>')
+    message.add_header('Cc', cc)
+    return message
+
+
+failed = 0
+for value, expected in CORPUS:
+    result = mail.parse_addresses(value)
+    if result != expected:
+        failed += 1
+        print('MISMATCH %r: expected %r, parsed %r' % (value, expected, result))
+    for address in LOOKUPS:
+        message = mail.Message()
+        message.add_header('To', value)
+        listed = address.lower() in expected
+        if message.lists_recipient(address) != listed:
+            failed += 1
+            print('MISMATCH %r: %s should be listed: %s'
+                    % (value, address, listed))
+
+print('Primary recipient check of %d recipients per message' %
+        options.recipients)
+for size in (10, 100, 1000, 10000):
+    # The recipients listed last are the worst case of the substring test
+    recipients = ['user%d@example.com' % (size - i - 1)
+            for i in xrange(min(size, options.recipients))]
+    cc = ',\r\n '.join('"User %d" <user%d@example.com>' % (i, i)
+            for i in xrange(size))
+    timings = []
+    for check in (substring_check, set_check, listed_check):
+        start = time.time()
+        for i in xrange(options.rounds):
+            message = build(cc)
+            for recipient in recipients:
+                if not check(message, recipient):
+                    failed += 1
+        timings.append((time.time() - start) / options.rounds * 1e6)
+    print('  Cc of %5d addresses: substring %9.1f us, set %9.1f us, '
+            'listed %9.1f us' % ((size,) + tuple(timings)))
+
+if failed:
+    print('%d failures!' % failed)
+    sys.exit(1)
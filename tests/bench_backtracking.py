@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+
+'''Worst case address matching benchmark and regression test
+
+Matches long crafted addresses (1k to 64k characters by default) against
+the sender and recipient rules, once with the combined regular expressions
+and once in linear time (ADDRESS_MATCHING). Each crafted address targets
+a rule that backtracks on it, like `(:?do)?.*not?.*(?:reply|...).*@` on
+`nonono...`.
+
+Both must find the very same rule for every address, the script exits
+with status 1 otherwise, or if the linear matching time grows a lot faster
+than the address length. The combined regular expressions are skipped for
+longer addresses once a single match took longer than --budget seconds,
+they would take minutes to hours.'''
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from optparse import OptionParser
+
+import validate
+import rules
+
+parser = OptionParser(usage='Usage: %prog [options]')
+parser.add_option('-n', '--rounds', dest='rounds', type='int', default=3,
+        help='rounds per measurement, the fastest counts (default: 3)')
+parser.add_option('-s', '--sizes', dest='sizes', default='1,2,4,8,16,32,64',
+        help='address lengths in 1024 characters (default: 1,2,4,...,64)')
+parser.add_option('-b', '--budget', dest='budget', type='float', default=0.5,
+        help='skip the combined matching of longer addresses once a match '
+             'took longer than this many seconds (default: 0.5)')
+parser.add_option('-R', '--rules', dest='rules', metavar='FILE',
+        help='use the rules of a rules file (e.g. rules.cfg)')
+
+(options, args) = parser.parse_args()
+
+# Linear matching may take this many times longer per character on the
+# longest address than on the shortest one (timer noise, caches, ...)
+MAX_GROWTH = 8
+
+# Name, address of a given length
+HOSTILE = [
+    ('at-signs', lambda n: 'a@' * (n // 2)),
+    ('noreply', lambda n: 'no' * (n // 2)),
+    ('noreply-late', lambda n: 'no' + 'reply' * (n // 5)),
+    ('relay', lambda n: 'relay-' * (n // 6)),
+    ('list-commands', lambda n: 'x-admin+' * (n // 8)),
+    ('automated', lambda n: 'x' * n + '.news'),
+    ('mailer', lambda n: 'mailer-' + 'x' * n),
+    ('null', lambda n: '<' * n),
+]
+
+
+def measure(matcher, address):
+    best = None
+    for i in xrange(options.rounds):
+        start = time.time()
+        result = matcher.match(address)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return result, best
+
+
+if options.rules:
+    ruleset = rules.RuleSet.load(options.rules)
+else:
+    ruleset = validate.RULES
+print('Using %d %s rules' % (len(ruleset), ruleset.source))
+print('Time per address: length, linear, combined')
+
+sizes = [int(size) * 1024 for size in options.sizes.split(',')]
+failed = 0
+
+for name, matcher in [
+        ('sender', ruleset.sender),
+        ('recipient', ruleset.recipient),
+        ]:
+    combined = rules.RegexpMatcher(matcher.regexps)
+    linear = rules.RegexpMatcher(matcher.regexps, linear=True)
+    fallback = [regexp.pattern for regexp, index in linear.runs
+            if not isinstance(regexp, rules.LinearPattern)]
+    print('%s: %d rules, %d without linear-time matching'
+            % (name.capitalize(), len(matcher.regexps), len(fallback)))
+
+    for hostile, craft in HOSTILE:
+        skip = False
+        timings = []
+        line = []
+        for size in sizes:
+            address = craft(size)
+            verdict, elapsed = measure(linear, address)
+            timings.append(elapsed / len(address))
+            if skip:
+                line.append('%6dk %9.1f us %12s' % (size // 1024,
+                        elapsed * 1e6, '-'))
+                continue
+            expected, regexp_elapsed = measure(combined, address)
+            if verdict != expected:
+                failed += 1
+                print('MISMATCH %s %s (%d): combined %r, linear %r'
+                        % (name, hostile, size, expected, verdict))
+            skip = regexp_elapsed > options.budget
+            line.append('%6dk %9.1f us %9.1f us' % (size // 1024,
+                    elapsed * 1e6, regexp_elapsed * 1e6))
+        growth = timings[-1] / max(timings[0], 1e-9)
+        if growth > MAX_GROWTH:
+            failed += 1
+        print('  %-14s verdict %-4r linear/char x%.1f%s'
+                % (hostile, verdict, growth,
+                   growth > MAX_GROWTH and ' NOT LINEAR' or ''))
+        for entry in line:
+            print('    %s' % entry)
+
+if failed:
+    print('%d failures!' % failed)
+    sys.exit(1)
@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+
+'''LMTP throughput benchmark for response-lmtpd
+
+Delivers messages over a number of concurrent LMTP connections to a running
+response-lmtpd and reports the achieved throughput. Run it against daemons
+configured differently (EVENT_LOOP, WORKERS, ...) to compare them.
+
+Use a large message size to measure the cost of receiving big attachments,
+e.g. `-c 2 -m 5 -s 20971520` delivers ten messages of 20 MB each.
+
+To compare two versions of the daemon, run each of them from its own
+checkout with the same configuration and the same options here. Take the
+median of a few runs, the throughput varies by 10-20% between runs.
+
+Connections that get no reply within --timeout seconds (e.g. dropped from
+a full listen queue) are reported as failed.'''
+
+import sys
+import time
+import socket
+import threading
+
+from optparse import OptionParser
+
+parser = OptionParser(usage='Usage: %prog [options] FROM TO')
+parser.add_option('-H', '--host', dest='host', default='127.0.0.1',
+        help='host of response-lmtpd (default: 127.0.0.1)')
+parser.add_option('-P', '--port', dest='port', type='int', default=10024,
+        help='port of response-lmtpd (default: 10024)')
+parser.add_option('-c', '--connections', dest='connections', type='int',
+        default=10, help='number of concurrent connections (default: 10)')
+parser.add_option('-m', '--messages', dest='messages', type='int',
+        default=100, help='messages per connection (default: 100)')
+parser.add_option('-r', '--recipients', dest='recipients', type='int',
+        default=1, help='recipients per message (default: 1)')
+parser.add_option('-s', '--size', dest='size', type='int', default=4096,
+        help='size of the message body in bytes (default: 4096)')
+parser.add_option('-b', '--bdat', action='store_true', dest='bdat',
+        help='pipeline all commands of a message and use BDAT instead of '
+             'DATA (one round trip per message)')
+parser.add_option('-t', '--timeout', dest='timeout', type='float',
+        default=30, help='seconds to wait for a reply (default: 30)')
+
+(options, args) = parser.parse_args()
+
+if len(args) != 2:
+    parser.print_help()
+    sys.exit(1)
+
+sender, recipient = args
+
+BODY_LINE = 'x' * 76 + '\r\n'
+
+
+def build_message(size):
+    headers = [
+        'From: %s' % sender,
+        'To: %s' % recipient.split('@', 1)[0].replace('#', '@'),
+        'Subject: Benchmark',
+        'Message-ID: <%f@bench.response>' % time.time(),
+    ]
+    body = BODY_LINE * (size // len(BODY_LINE) + 1)
+    message = '\r\n'.join(headers) + '\r\n\r\n' + body[:size]
+    if options.bdat:
+        return message
+    return message + '\r\n.\r\n'
+
+
+class Client(threading.Thread):
+
+    def __init__(self, message):
+        threading.Thread.__init__(self)
+        self.message = message
+        self.delivered = 0
+        self.errors = 0
+        self.failure = None
+        self.buffer = ''
+
+    def reply(self):
+        # Read one (possibly multi-line) reply, return the status code
+        while True:
+            while '\r\n' not in self.buffer:
+                data = self.sock.recv(4096)
+                if not data:
+                    raise socket.error('connection closed')
+                self.buffer += data
+            line, self.buffer = self.buffer.split('\r\n', 1)
+            if line[3:4] != '-':
+                return int(line[:3])
+
+    def command(self, line):
+        self.sock.sendall(line + '\r\n')
+        return self.reply()
+
+    def run(self):
+        try:
+            self.deliver()
+        except socket.error, e:
+            self.failure = e
+            sys.stderr.write('%s: %s\n' % (self.getName(), e))
+
+    def deliver(self):
+        self.sock = socket.create_connection((options.host, options.port),
+                options.timeout)
+        self.reply()
+        self.command('LHLO bench.response')
+        for i in range(options.messages):
+            if options.bdat:
+                self.send_pipelined()
+                continue
+            self.command('MAIL FROM:<%s>' % sender)
+            for r in range(options.recipients):
+                self.command('RCPT TO:<%s>' % recipient)
+            self.command('DATA')
+            self.sock.sendall(self.message)
+            for r in range(options.recipients):
+                if self.reply() == 250:
+                    self.delivered += 1
+                else:
+                    self.errors += 1
+        self.command('QUIT')
+        self.sock.close()
+
+    def send_pipelined(self):
+        commands = ['MAIL FROM:<%s>' % sender]
+        commands.extend(['RCPT TO:<%s>' % recipient] * options.recipients)
+        commands.append('BDAT %d LAST' % len(self.message))
+        self.sock.sendall('\r\n'.join(commands) + '\r\n' + self.message)
+        for command in commands[:-1]:
+            self.reply()
+        for r in range(options.recipients):
+            if self.reply() == 250:
+                self.delivered += 1
+            else:
+                self.errors += 1
+
+
+message = build_message(options.size)
+clients = [Client(message) for i in range(options.connections)]
+
+start = time.time()
+for client in clients:
+    client.start()
+for client in clients:
+    client.join()
+elapsed = time.time() - start
+
+messages = options.connections * options.messages
+delivered = sum(client.delivered for client in clients)
+errors = sum(client.errors for client in clients)
+failed = len([client for client in clients if client.failure])
+
+print('Connections:     %d (%d failed)' % (options.connections, failed))
+print('Messages:        %d (%d bytes each)' % (messages, len(message)))
+print('Recipients:      %d delivered, %d errors' % (delivered, errors))
+print('Elapsed:         %.3f s' % elapsed)
+print('Throughput:      %.1f messages/s, %.1f recipients/s, %.2f MB/s'
+        % (messages / elapsed, delivered / elapsed,
+           messages * len(message) / elapsed / 1024 / 1024))
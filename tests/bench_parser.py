@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+
+'''Message header parser benchmark and regression test
+
+Feeds a corpus of messages to mail.Parser in chunks, the way lmtpd
+receives them, and to email.feedparser.FeedParser (the base of the
+previous mail.Parser). Both must find the very same headers (names and
+raw values, in order) for every message and chunk size, the script exits
+with status 1 otherwise. The cost per message is reported for each.
+
+Additional messages can be given in files (one message per file).'''
+
+import os
+import sys
+import time
+import email.feedparser
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from optparse import OptionParser
+
+import mail
+
+parser = OptionParser(usage='Usage: %prog [options] [FILE ...]')
+parser.add_option('-n', '--rounds', dest='rounds', type='int', default=200,
+        help='rounds over the corpus per measurement (default: 200)')
+parser.add_option('-s', '--chunk-size', dest='chunk_size', type='int',
+        default=8192, help='size of the fed chunks (default: 8192)')
+
+(options, args) = parser.parse_args()
+
+# A typical header block of a message that passed a few relays
+HEADERS = ''.join([
+    'Return-Path: <john.doe@example.com>\r\n',
+    ''.join('Received: from mx%d.example.net (mx%d.example.net [10.0.0.%d])\r\n'
+            '\tby mail.example.com (Postfix) with ESMTP id 3F2A1%d\r\n'
+            '\tfor <jane@example.com>; Mon, 1 Feb 2010 12:00:%02d +0100\r\n'
+            % (i, i, i, i, i) for i in range(12)),
+    'DKIM-Signature: v=1; a=rsa-sha256; c=relaxed/relaxed; d=example.net;\r\n'
+            ' s=mail; h=from:to:subject; bh=abc=; b=def=\r\n',
+    'From: John Doe <john.doe@example.com>\r\n',
+    'To: Jane Roe <jane@example.com>, "Doe, John" <john@example.com>\r\n',
+    'Cc: =?utf-8?q?J=C3=BCrgen?= <juergen@example.com>\r\n',
+    'Subject: Lunch tomorrow?\r\n',
+    'Date: Mon, 1 Feb 2010 12:00:00 +0100\r\n',
+    'Message-ID: <1234@example.com>\r\n',
+    'MIME-Version: 1.0\r\n',
+    'Content-Type: text/plain; charset=utf-8\r\n',
+])
+
+BODY = 'Hello Jane,\r\n\r\nSee you tomorrow!\r\n' * 100
+
+CORPUS = [
+    HEADERS + '\r\n' + BODY,
+    # Unix line endings
+    HEADERS.replace('\r\n', '\n') + '\n' + BODY,
+    # Headers only, no body, no separator
+    HEADERS,
+    # Empty and odd header values, no space after the colon
+    'Subject:\r\nX-Empty: \r\nX-Tight:tight\r\nX-Trailing: x  \r\n\r\nbody\r\n',
+    # Continuation before the first header, mbox From_ line
+    ' lost\r\nFrom john@example.com Mon Feb  1 12:00:00 2010\r\n'
+            'Subject: x\r\n\r\n',
+    # Not a header line: ends the headers
+    'Subject: x\r\nno header here\r\nX-After: y\r\n\r\n',
+    'Subject: x\r\nX Space: y\r\n\r\n',
+    # Folded lines and a long header
+    'Subject: a\r\n b\r\n\tc\r\nX-Long: ' + 'x' * 10000 + '\r\n\r\n',
+]
+
+
+def items(message):
+    return [(name, value) for name, value in message.items()]
+
+
+def feed(factory, data, size):
+    parser = factory()
+    for i in xrange(0, len(data), size):
+        parser.feed(data[i:i + size])
+        if getattr(parser, 'headers_complete', False):
+            break
+    return parser.close()
+
+
+def new_parser():
+    return mail.Parser(mail.Message)
+
+
+def old_parser():
+    # The previous mail.Parser did not parse the body either
+    parser = email.feedparser.FeedParser()
+    parser._set_headersonly()
+    return parser
+
+
+def measure(factory, corpus):
+    start = time.time()
+    for i in xrange(options.rounds):
+        for data in corpus:
+            feed(factory, data, options.chunk_size)
+    return (time.time() - start) / (options.rounds * len(corpus)) * 1e6
+
+
+corpus = list(CORPUS)
+for filename in args:
+    corpus.append(open(filename, 'rb').read())
+
+failed = 0
+for data in corpus:
+    for size in (1, 7, 64, options.chunk_size):
+        expected = items(feed(old_parser, data, size))
+        result = items(feed(new_parser, data, size))
+        if result != expected:
+            failed += 1
+            print('MISMATCH (chunks of %d) %r: feedparser %r, mail %r'
+                    % (size, data[:40], expected, result))
+
+print('Parsing %d messages in chunks of %d octets' % (len(corpus),
+        options.chunk_size))
+print('  per message: feedparser %7.1f us, mail %7.1f us' % (
+        measure(old_parser, corpus), measure(new_parser, corpus)))
+
+if failed:
+    print('%d mismatches!' % failed)
+    sys.exit(1)
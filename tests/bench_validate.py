@@ -0,0 +1,286 @@
+#!/usr/bin/env python
+
+'''Address and header validation benchmark and regression test
+
+Matches a corpus of addresses against INVALID_SENDER_RE and
+INVALID_RECIPIENT_RE, once with a loop over the single regular expressions
+(the way validate.py used to do it) and once with the matchers, combined
+and linear. All must find the very same rule for every address, the
+script exits with status 1 otherwise. The cost per address is reported
+for each, and for the combined matchers with a verdict cache holding the
+whole corpus. See bench_backtracking.py for long crafted addresses.
+
+The same is done for the header rules with a corpus of messages: the
+nested loops over all header names and rules against validate_headers.
+
+Additional addresses (one per line) can be given in files, e.g. the
+envelope senders found in the mail log.
+
+With -R, the rules of a rules file are used instead of the built-in rules
+(they must still find the same rules as the loops over the built-in lists,
+which holds for the shipped rules.cfg).'''
+
+import os
+import sys
+import time
+import email
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from optparse import OptionParser
+
+import validate
+import rules
+
+parser = OptionParser(usage='Usage: %prog [options] [FILE ...]')
+parser.add_option('-n', '--rounds', dest='rounds', type='int', default=200,
+        help='rounds over the corpus per measurement (default: 200)')
+parser.add_option('-R', '--rules', dest='rules', metavar='FILE',
+        help='use the rules of a rules file (e.g. rules.cfg)')
+
+(options, args) = parser.parse_args()
+
+CORPUS = [
+    # Valid (the common case)
+    'john.doe@example.com',
+    'Jane_Roe@example.org',
+    'j@x.de',
+    'firstname.lastname+tag@sub.domain.example.net',
+    'k.mueller@t-online.de',
+    'friend@gmx.de',
+    'alice@mail.example.co.uk',
+    'bob-smith@example.com',
+    'a' * 64 + '@' + 'b' * 60 + '.com',
+    # Null sender and sender domains
+    '<>',
+    'member@facebookmail.com',
+    'payments@paypal.de',
+    'ship-confirm@amazon.com',
+    'x@last.fm',
+    'x@lastXfm.com',
+    'noreply@steampowered.com',
+    # Administrative
+    'MAILER-DAEMON@example.com',
+    'mailer_daemon@example.com',
+    'mailer@example.com',
+    'root@example.com',
+    'Root@Example.com',
+    'dns-admin@example.com',
+    'webmaster@example.com',
+    'www-data@example.com',
+    'httpd@example.com',
+    'mx-relay@example.com',
+    'outgoing@example.com',
+    # Mailing lists
+    'bugzilla@example.com',
+    'trac@example.com',
+    'majordom@example.com',
+    'mailman@example.com',
+    'users-request@lists.example.com',
+    'users-subscribe+john=example.com@lists.example.com',
+    'users-unsubscribe@lists.example.com',
+    'dev-owner@lists.example.com',
+    # No-reply
+    'noreply@example.com',
+    'no-reply@example.com',
+    'do.not.reply@example.com',
+    'donotanswer@example.com',
+    'noreturn@example.com',
+    # Automated
+    'newsletter@example.com',
+    'info@example.com',
+    'information@example.com',
+    'cron@example.com',
+    'robot@example.com',
+    'sms-gateway@example.com',
+    'status@example.com',
+    # Business
+    'shop@example.com',
+    'invoice@example.com',
+    'support@example.com',
+    'rechnung@example.de',
+    'bestellung@example.de',
+    'zahlung@example.de',
+    'versand@example.de',
+    # Community
+    'password-reset@example.com',
+    'account@example.com',
+    'forum@example.com',
+    'upload@example.com',
+    # Near misses
+    'rooter@example.com',
+    'admins@example.com',
+    'an@example.com',
+    'trace@example.com',
+]
+
+
+# A typical header block of a message that passed a few relays
+HEADERS = ''.join([
+    'Return-Path: <john.doe@example.com>\n',
+    ''.join('Received: from mx%d.example.net (mx%d.example.net [10.0.0.%d])\n'
+            '\tby mail.example.com (Postfix) with ESMTP id 3F2A1%d\n'
+            '\tfor <jane@example.com>; Mon, 1 Feb 2010 12:00:%02d +0100\n'
+            % (i, i, i, i, i) for i in range(12)),
+    ''.join('ARC-Seal: i=%d; a=rsa-sha256; cv=pass; d=example.net; s=arc; '
+            'b=abcdef%d\n' % (i, i) for i in range(3)),
+    'DKIM-Signature: v=1; a=rsa-sha256; c=relaxed/relaxed; d=example.net; '
+            's=mail; h=from:to:subject; bh=abc=; b=def=\n',
+    'Authentication-Results: mail.example.com; dkim=pass\n',
+    'X-Spam-Status: No, score=-1.0\n',
+    'From: John Doe <john.doe@example.com>\n',
+    'To: Jane Roe <jane@example.com>\n',
+    'Subject: Lunch tomorrow?\n',
+    'Date: Mon, 1 Feb 2010 12:00:00 +0100\n',
+    'Message-ID: <1234@example.com>\n',
+    'MIME-Version: 1.0\n',
+    'Content-Type: text/plain; charset=utf-8\n',
+])
+
+HEADER_CORPUS = [HEADERS] + [HEADERS + header + '\n' for header in [
+    'List-Id: <users.lists.example.com>',
+    'Mailing-List: contact users-help@example.com',
+    'X-Mailman-Version: 2.1.12',
+    'Resent-Message-ID: <5678@example.com>',
+    'Auto-Submitted: auto-replied',
+    'X-Loop: jane@example.com',
+    'X-Autoreply: yes',
+    'X-Auto-Response-Suppress: All',
+    'Precedence: bulk',
+    'Precedence: first-class',
+    'X-MimeOLE: Produced by PHP',
+    'X-MimeOLE: Produced By Microsoft MimeOLE',
+    'X-Spam-Flag: YES',
+    'X-Spam-Flag: NO',
+    'Content-Class: urn:content-classes:calendarmessage',
+    'Subject: Out of Office',
+    'Subject: Autoreply',
+    'Subject: Newsletter February',
+    'Subject: Re: Cron jobs',
+    'approved-by: moderator@example.com',
+]]
+
+
+def loop_headers(message):
+    for header_name in message.keys():
+        for regexp in validate.INVALID_HEADER_NAME_RE:
+            if regexp.match(header_name):
+                return (header_name, message.get(header_name))
+    for header_name, header_value in message.items():
+        for name_regexp, value_regexps in validate.INVALID_HEADER_VALUE_RE:
+            if name_regexp.match(header_name):
+                for value_regexp in value_regexps:
+                    if value_regexp.match(header_value):
+                        return (header_name, header_value)
+    return None
+
+
+def indexed_headers(message):
+    try:
+        validate.validate_headers(message, ruleset)
+    except validate.exception.InvalidHeaderError, e:
+        return str(e)
+    return None
+
+
+def loop_match(regexps, address):
+    for index, regexp in enumerate(regexps):
+        if regexp.match(address):
+            return index
+    return None
+
+
+def measure(function, regexps, corpus):
+    start = time.time()
+    for i in xrange(options.rounds):
+        for address in corpus:
+            function(regexps, address)
+    return (time.time() - start) / (options.rounds * len(corpus)) * 1e6
+
+
+if options.rules:
+    ruleset = rules.RuleSet.load(options.rules)
+else:
+    ruleset = validate.RULES
+print('Using %d %s rules' % (len(ruleset), ruleset.source))
+
+corpus = list(CORPUS)
+for filename in args:
+    corpus.extend(line.strip() for line in open(filename) if line.strip())
+
+valid = [address for address in corpus
+        if loop_match(validate.INVALID_SENDER_RE, address) is None]
+
+failed = 0
+
+for name, regexps, matcher in [
+        ('sender', validate.INVALID_SENDER_RE, ruleset.sender),
+        ('recipient', validate.INVALID_RECIPIENT_RE, ruleset.recipient),
+        ]:
+    results = {}
+    for variant, linear, cache_size in [
+            ('combined', False, 0),
+            ('linear', True, 0),
+            ('cached', False, len(corpus)),
+            ]:
+        matcher.linear = linear
+        matcher.cache_size = cache_size
+        matcher.compile()
+        # Twice: with an empty and with a filled verdict cache
+        for address in corpus + corpus:
+            expected = loop_match(regexps, address)
+            result = matcher.match(address)
+            if result != expected:
+                failed += 1
+                print('MISMATCH %s %r: loop %r, %s %r'
+                        % (name, address, expected, variant, result))
+        results[variant] = (
+            measure(lambda r, a: matcher.match(a), regexps, corpus),
+            measure(lambda r, a: matcher.match(a), regexps, valid),
+        )
+    loop_all = measure(loop_match, regexps, corpus)
+    loop_valid = measure(loop_match, regexps, valid)
+
+    print('%s: %d rules in %d combined runs' % (name.capitalize(),
+            len(regexps), len(matcher.runs)))
+    for title, addresses, loop_time, column in [
+            ('all addresses', corpus, loop_all, 0),
+            ('valid addresses', valid, loop_valid, 1),
+            ]:
+        print('  %-15s (%4d): loop %6.2f us, combined %6.2f us, '
+                'linear %6.2f us, cached %6.2f us' % (title, len(addresses),
+                loop_time, results['combined'][column],
+                results['linear'][column], results['cached'][column]))
+
+messages = [email.message_from_string(headers + '\nBody\n')
+        for headers in HEADER_CORPUS]
+for message in messages:
+    expected = loop_headers(message)
+    if expected is not None:
+        expected = 'Invalid header: %s: %s' % expected
+    result = indexed_headers(message)
+    if result != expected:
+        failed += 1
+        print('MISMATCH headers %r: loop %r, indexed %r'
+                % (message.keys()[-1], expected, result))
+
+rounds = max(1, options.rounds // 10)
+start = time.time()
+for i in xrange(rounds):
+    for message in messages:
+        loop_headers(message)
+loop_time = (time.time() - start) / (rounds * len(messages)) * 1e6
+start = time.time()
+for i in xrange(rounds):
+    for message in messages:
+        indexed_headers(message)
+indexed_time = (time.time() - start) / (rounds * len(messages)) * 1e6
+
+print('Headers: %d messages with %d headers each' % (len(messages),
+        len(messages[0])))
+print('  per message:           loop %6.1f us, indexed %6.1f us'
+        % (loop_time, indexed_time))
+
+if failed:
+    print('%d mismatches!' % failed)
+    sys.exit(1)
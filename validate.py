@@ -25,6 +25,7 @@ from globals import __author__, __copyright__, __license__, __version__
 import re
 import exception
 
+from rules import RuleSet
 from logger import getModuleLog
 log = getModuleLog(__name__)
 
@@ -266,53 +267,54 @@ INVALID_SENDER_RE = [
         # and other stuff that should not be replied to.
         re.compile('<>'),
 
-        # Sender domains
-        re.compile(
-        '''
-        .*
-        @
-        .*
-        (?:
+] # end of sender regexps
+
+#
+# List of INVALID SENDER domains, matched against the domain part of the
+# sender address. Subdomains of a listed domain are invalid, too.
+#
+INVALID_SENDER_DOMAINS = [
+
         # Huge online stores
-            ebay
-        |   paypal
-        |   amazon
+        'ebay.com', 'ebay.de', 'ebay.at', 'ebay.ch', 'ebay.co.uk', 'ebay.fr',
+        'ebay.it', 'ebay.es', 'ebay.nl', 'ebay.be', 'ebay.pl', 'ebay.ca',
+        'ebay.com.au',
+        'paypal.com', 'paypal.de', 'paypal.at', 'paypal.ch', 'paypal.co.uk',
+        'paypal.fr', 'paypal.it', 'paypal.es', 'paypal.nl', 'paypal.be',
+        'paypal.pl', 'paypal.ca', 'paypal.com.au',
+        'amazon.com', 'amazon.de', 'amazon.at', 'amazon.co.uk', 'amazon.fr',
+        'amazon.it', 'amazon.es', 'amazon.ca', 'amazon.co.jp', 'amazon.cn',
+        'amazonses.com',
 
         # Huge social networking sites
         # http://en.wikipedia.org/wiki/List_of_social_networking_websites
-        |   facebook
-        |   myspace
-        |   twitter
-        |   linkedin
-        |   last.fm
-        |   live.com
-        |   xing
-        |   badoo
-        |   bebo
-        |   buzznet
-        |   classmates
-        |   dating
-        |   hi5
-        |   hyves
-        |   imeem
-        |   kaixin001
-        |   meetup
-        |   qzone
-        |   renren
-        |   studivz
-        |   schuelervz
-        |   meinvz
+        'facebook.com', 'facebookmail.com',
+        'myspace.com',
+        'twitter.com',
+        'linkedin.com',
+        'last.fm', 'lastfm.de',
+        'live.com',
+        'xing.com',
+        'badoo.com',
+        'bebo.com',
+        'buzznet.com',
+        'classmates.com',
+        'hi5.com',
+        'hyves.nl',
+        'imeem.com',
+        'kaixin001.com',
+        'meetup.com',
+        'qzone.qq.com',
+        'renren.com',
+        'studivz.net', 'schuelervz.net', 'meinvz.net',
 
         # Gaming sites
-        |   steam
-        |   gamespy
-        |   fileplanet
-        |   filefront
-        )
-        .*
-        ''', re.VERBOSE | re.IGNORECASE),
+        'steampowered.com', 'steamcommunity.com',
+        'gamespy.com',
+        'fileplanet.com',
+        'filefront.com',
 
-] # end of sender regexps
+] # end of sender domains
 
 # Add unwanted addresses to the list
 INVALID_SENDER_RE.extend(MATCH_ADMIN_ADDRESS_RE)
@@ -350,6 +352,22 @@ INVALID_RECIPIENT_RE.extend(MATCH_BUSINESS_ADDRESS_RE)
 INVALID_RECIPIENT_RE.extend(MATCH_COMMUNITY_ADDRESS_RE)
 
 
+# Names of the rule groups, reported with a matching expression
+RULE_GROUPS = [
+        ('admin', MATCH_ADMIN_ADDRESS_RE),
+        ('list', MATCH_LIST_ADDRESS_RE),
+        ('noreply', MATCH_NOREPLY_ADDRESS_RE),
+        ('automated', MATCH_AUTOMATED_ADDRESS_RE),
+        ('business', MATCH_BUSINESS_ADDRESS_RE),
+        ('community', MATCH_COMMUNITY_ADDRESS_RE),
+]
+
+# Domain groups: (name, addresses the domains apply to, domains)
+DOMAIN_GROUPS = [
+        ('bulk', ['sender'], INVALID_SENDER_DOMAINS),
+]
+
+
 #
 # List of INVALID HEADER NAME regular expressions, matched against all headers
 # of a parsed message. Note that this only matches the header name, not the
@@ -482,12 +500,66 @@ INVALID_HEADER_VALUE_RE = [
 ] # end of invalid header value regexps
 
 
-def validate_headers(message):
+#
+# The rules in use, either compiled from the lists above or loaded from
+# a rules file (see load_rules). Always replaced as a whole, validate()
+# uses the same rules for all steps of a message.
+#
+RULES = RuleSet(INVALID_SENDER_RE, INVALID_RECIPIENT_RE,
+        INVALID_HEADER_NAME_RE, INVALID_HEADER_VALUE_RE, RULE_GROUPS,
+        domains=DOMAIN_GROUPS)
+
+
+def load_rules(filename=None, cache_size=0, profile=None, linear=False):
+    '''Replace the rules in use with the rules of a rules file, or with the
+    built-in rules if no file is given. Cache the verdicts of up to
+    cache_size addresses per address matcher (0 disables the cache).
+    Count the rules and validation stages in profile, if given. Match the
+    address rules in linear time where possible if linear is set.
+
+    Return the rules replaced. Raises ConfigError if the file is invalid,
+    the rules in use stay untouched then.'''
+
+    global RULES
+
+    if filename:
+        rules = RuleSet.load(filename, cache_size, profile, linear)
+    else:
+        rules = RuleSet(INVALID_SENDER_RE, INVALID_RECIPIENT_RE,
+                INVALID_HEADER_NAME_RE, INVALID_HEADER_VALUE_RE, RULE_GROUPS,
+                cache_size, profile=profile, linear=linear,
+                domains=DOMAIN_GROUPS)
+    previous, RULES = RULES, rules
+    log.info('Loaded %d %s validation rules and %d domains' % (len(rules),
+            rules.source, sum(rules.domain_counts.values())))
+    return previous
+
+
+def verdict_cache_stats():
+    '''Return (name, size, hits, misses) of each address matcher cache'''
+
+    return RULES.cache_stats()
+
+
+def rule_files():
+    '''Return the files the rules in use were loaded from'''
+
+    return RULES.files
+
+
+def rule_stats():
+    '''Return (kind, group, pattern, hits) of each rule in use'''
+
+    return RULES.stats()
+
+
+def validate_headers(message, rules=None):
     '''Header validation:
 
     Given a parsed message object, validate if this message may trigger
     an autoresponse.'''
 
+    headers = (rules or RULES).headers
     invalid_header = (None, None)
     valid = True
 
@@ -495,28 +567,28 @@ def validate_headers(message):
 
     # Validate header *NAMES*
     for header_name in message.keys():
-        for regexp in INVALID_HEADER_NAME_RE:
-            if regexp.match(header_name):
-                invalid_header = (header_name, message.get(header_name))
-                valid = False
-                break
-        if not valid:
+        if headers.invalid_name(header_name):
+            invalid_header = (header_name, message.get(header_name))
+            valid = False
             break
 
-    # Validate header *VALUES*
+    # Validate header *VALUES* (only of headers with value rules), raw
+    # and, if they hold encoded words, decoded (RFC 2047). Values are
+    # decoded only if a rule applies.
     if valid:
-        for header_name, header_value in message.items():
-            for name_regexp, value_regexps in INVALID_HEADER_VALUE_RE:
-                if name_regexp.match(header_name):
-                    for value_regexp in value_regexps:
-                        if value_regexp.match(header_value):
-                            invalid_header = (header_name, header_value)
-                            valid = False
-                            break
-                if not valid:
-                    break
-            if not valid:
+        for index, (header_name, header_value) in enumerate(message.items()):
+            if headers.invalid_value(header_name, header_value):
+                invalid_header = (header_name, header_value)
+                valid = False
                 break
+            if '=?' in header_value \
+                    and headers.lookup(header_name)[1] is not None:
+                decoded = message.get_decoded(index)
+                if decoded != header_value \
+                        and headers.invalid_value(header_name, decoded):
+                    invalid_header = (header_name, decoded)
+                    valid = False
+                    break
 
     if valid:
         log.debug('Header validation successful!')
@@ -526,7 +598,7 @@ def validate_headers(message):
                 % invalid_header)
 
 
-def validate_recipient(manager, message):
+def validate_recipient(manager, message, index=None, rules=None):
     '''Recipient validation:
 
     Given a parsed message object, validate if the local recipient has
@@ -540,22 +612,28 @@ def validate_recipient(manager, message):
     # First of all, don't respond to messages that don't list us as one
     # of the primary recipients. This can happen with address rewriting
     # due to virtual aliases.
-    if not (recipient in message.get('To', failobj='')
-        or  recipient in message.get('Cc', failobj='')):
+    if not message.lists_recipient(recipient):
         valid = False
 
     # Validate against the list of invalid recipient regexps before
     # involving the backend in any way
     if valid:
-        for regexp in INVALID_RECIPIENT_RE:
-            if regexp.match(recipient):
-                valid = False
-                break
+        valid = valid_recipient_address(recipient, rules)
 
-    if valid:
+    # Known configs don't need the backend at all
+    if valid and index is not None and index.ready:
+        if recipient not in index:
+            log.debug('Recipient validation failed!')
+            raise exception.InvalidRecipientError(
+                    'No enabled autoresponse config for %s' % recipient)
+        log.debug('Recipient validation successful!')
+    elif valid:
         try:
             manager.validate_recipient(recipient)
             log.debug('Recipient validation successful!')
+        except exception.DatabaseError:
+            # Backend unavailable, this is no verdict
+            raise
         except Exception, e:
             log.debug('Recipient validation failed!')
             raise exception.InvalidRecipientError('Invalid recipient %s - %s'
@@ -565,27 +643,51 @@ def validate_recipient(manager, message):
         raise exception.InvalidRecipientError('Invalid recipient %s' % recipient)
 
 
-def validate_sender(message):
+def valid_recipient_address(recipient, rules=None):
+    '''Envelope recipient validation:
+
+    Given the local recipient address only, check if it is not in the list
+    of invalid recipients. The message itself is not needed.'''
+
+    rules = rules or RULES
+    rule = rules.match_recipient(recipient)
+    if rule is not None:
+        log.debug('Recipient %s matches %s' % (recipient, rule))
+        return False
+    return True
+
+
+def valid_sender_address(sender, recipient=None, rules=None):
+    '''Envelope sender validation:
+
+    Given the sender address (and the local recipient, if known) only,
+    check if the sender may receive an auto-response. The message itself
+    is not needed.'''
+
+    # Don't loop on our own...
+    if sender == recipient:
+        return False
+
+    # Validate against the huge list of invalid sender regexps
+    rules = rules or RULES
+    rule = rules.match_sender(sender)
+    if rule is not None:
+        log.debug('Sender %s matches %s' % (sender, rule))
+        return False
+    return True
+
+
+def validate_sender(message, rules=None):
     '''Sender validation:
 
     Given a parsed message object, validate if the sender may receive
     an auto-response.'''
 
     sender = message.get_unixfrom()
-    valid = True
 
     log.debug('Validating sender: %s' % sender)
 
-    # Don't loop on our own...
-    if sender == message.get_unixto():
-        valid = False
-
-    # Validate against the huge list of invalid sender regexps
-    if valid:
-        for regexp in INVALID_SENDER_RE:
-            if regexp.match(sender):
-                valid = False
-                break
+    valid = valid_sender_address(sender, message.get_unixto(), rules)
 
     if valid:
         log.debug('Sender validation successful!')
@@ -594,17 +696,29 @@ def validate_sender(message):
         raise exception.InvalidSenderError('Invalid sender %s' % sender)
 
 
-def validate(manager, message):
+def stage(rules, name, function, *args):
+    '''Run a validation stage, profiled if the rules are'''
+
+    if rules.profile is None:
+        return function(*args)
+    return rules.profile.call(('stage', name, None), function, *args)
+
+
+def validate(manager, message, index=None):
     '''Message validation using the above defined functions'''
 
     log.debug('Validating message...')
 
+    # The rules may be replaced while we are at it
+    rules = RULES
+
     try:
         # Local parsing only:
-        validate_sender(message)
-        validate_headers(message)
+        stage(rules, 'sender', validate_sender, message, rules)
+        stage(rules, 'headers', validate_headers, message, rules)
         # Involves backend:
-        validate_recipient(manager, message)
+        stage(rules, 'recipient', validate_recipient, manager, message,
+                index, rules)
     except exception.ValidationError, e:
         log.info('Message validation (%s -> %s) failed: %s'
                 % (message.get_unixfrom(), message.get_unixto(), e))
@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+
+'''Response Project - Backend Worker Threads'''
+
+# Copyright (C) 2009-2010 John Feuerstein <john@feurix.com>
+#
+# This file is part of the response project.
+#
+# Response is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# Response is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Library General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+# ---
+#
+# Blocking work (database queries) is handed to a fixed number of threads
+# through a bounded queue. Results are passed back to the asyncore event
+# loop thread by writing to a pipe that is part of the loop's socket map,
+# so all callbacks run in the event loop thread and never need locking.
+
+from globals import __author__, __copyright__, __license__, __version__
+
+import os
+import fcntl
+import errno
+import socket
+import asyncore
+import threading
+import Queue
+import exception
+
+from collections import deque
+from functools import partial
+
+from logger import getModuleLog
+log = getModuleLog(__name__)
+
+
+# How long to wait for each thread to finish its current job on close()
+JOIN_TIMEOUT = 1.0
+
+class Trigger(asyncore.file_dispatcher):
+    '''Wake up the event loop and run callbacks in the event loop thread'''
+
+    def __init__(self):
+        self._read_fd, self._write_fd = os.pipe()
+        flags = fcntl.fcntl(self._write_fd, fcntl.F_GETFL)
+        fcntl.fcntl(self._write_fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        asyncore.file_dispatcher.__init__(self, self._read_fd)
+        os.close(self._read_fd)
+        self._callbacks = deque()
+
+    def readable(self):
+        return True
+
+    def writable(self):
+        return False
+
+    def handle_connect(self):
+        pass
+
+    def pull(self, callback):
+        '''Schedule callback() in the event loop thread. Thread safe.'''
+        self._callbacks.append(callback)
+        try:
+            os.write(self._write_fd, 'x')
+        except OSError, e:
+            # A full pipe will wake up the loop anyway
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def handle_read(self):
+        try:
+            self.recv(4096)
+        except socket.error:
+            pass
+        while self._callbacks:
+            callback = self._callbacks.popleft()
+            try:
+                callback()
+            except Exception, e:
+                log.error('Unhandled exception in callback: %s' % e)
+
+    def close(self):
+        asyncore.file_dispatcher.close(self)
+        try:
+            os.close(self._write_fd)
+        except OSError:
+            pass
+
+
+class WorkerPool(object):
+    '''Fixed number of threads working on a bounded job queue'''
+
+    def __init__(self, threads, queue_size):
+        self.queue = Queue.Queue(queue_size)
+        self.trigger = Trigger()
+        self.threads = []
+
+        for i in range(threads):
+            thread = threading.Thread(target=self._work,
+                    name='BackendWorker-%d' % i)
+            thread.setDaemon(True)
+            thread.start()
+            self.threads.append(thread)
+
+        log.info('Started %d backend worker threads (queue size: %d)'
+                % (threads, queue_size))
+
+    def submit(self, function, args, callback):
+        '''Run function(*args) in a worker thread and pass the result to
+        callback() in the event loop thread.
+
+        If function raises an exception, callback() gets None.'''
+
+        try:
+            self.queue.put_nowait((function, args, callback))
+        except Queue.Full:
+            raise exception.QueueFullError(
+                    'Backend queue full (%d jobs pending)'
+                    % self.queue.qsize())
+
+    def _work(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                break
+            function, args, callback = job
+            try:
+                result = function(*args)
+            except Exception, e:
+                log.error('Unhandled exception in backend worker: %s' % e)
+                result = None
+            self.trigger.pull(partial(callback, result))
+
+    def close(self):
+        # Threads busy with a hanging backend are daemonic and don't block
+        # the shutdown.
+        for thread in self.threads:
+            try:
+                self.queue.put_nowait(None)
+            except Queue.Full:
+                break
+        for thread in self.threads:
+            thread.join(JOIN_TIMEOUT)
+        self.trigger.close()